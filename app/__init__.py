@@ -0,0 +1,4 @@
+import time
+
+# Reference point for the import/startup time budget reported by /readyz
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,86 @@
+"""Per-tenant usage analytics: feature counts over hour/day/week buckets.
+
+The hot table is pre-aggregated in SQL to (feature, hour or day, count) rows, so its part
+is bounded by features x periods however much usage the range holds. Archived segments are
+read as column arrays (feature, timestamp). Both are bucketed with NumPy: one floor-divide
+turns period starts / timestamps into bucket indexes and one weighted bincount over
+(feature, bucket) produces every series at once.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import Date, cast, func, select
+import numpy as np
+
+from app.archive import EPOCH, scan_archived_columns
+from app.models import Usage
+
+BUCKETS = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}
+# Weeks start on Monday; 1970-01-05 is the first Monday after the epoch
+BUCKET_ORIGINS = {"hour": EPOCH, "day": EPOCH, "week": datetime(1970, 1, 5)}
+ANALYTICS_MAX_BUCKETS = 5000
+ANALYTICS_MAX_RANGE = timedelta(days=371)  # a year (plus alignment) of day or week buckets
+US = 1000000
+
+
+def align_range(start: datetime, end: datetime, bucket: str):
+    """Widen [start, end) to whole buckets, so equivalent requests share a cache entry."""
+    width, origin = BUCKETS[bucket], BUCKET_ORIGINS[bucket]
+    start = origin + (start - origin) // width * width
+    end = origin + -((origin - end) // width) * width
+    return start, end
+
+
+def _to_us(values) -> np.ndarray:
+    # Period starts come back as datetimes, dates or strings depending on the dialect
+    return np.asarray([str(v) for v in values], dtype="datetime64[us]").astype(np.int64)
+
+
+def hot_counts_query(dialect: str, tenant_id: int, start: datetime, end: datetime, bucket: str):
+    """(feature, period start, count) of a tenant's hot usage in [start, end), per hour for hourly buckets, else per day."""
+    if bucket != "hour":
+        period = cast(Usage.timestamp, Date) if dialect == "postgresql" else func.date(Usage.timestamp)
+    elif dialect == "mysql":
+        period = func.date_format(Usage.timestamp, "%Y-%m-%d %H:00:00")
+    elif dialect == "postgresql":
+        period = func.date_trunc("hour", Usage.timestamp)
+    else:
+        period = func.strftime("%Y-%m-%d %H:00:00", Usage.timestamp)
+    return select(Usage.feature, period, func.count(Usage.id)) \
+        .where(Usage.tenant_id == tenant_id, Usage.timestamp >= start, Usage.timestamp < end) \
+        .group_by(Usage.feature, period)
+
+
+def usage_histogram(hot_counts: list, tenant_id: int, shard: str, start: datetime, end: datetime, bucket: str) -> dict:
+    """Bucket a tenant's usage in [start, end) (aligned ranges) by feature.
+
+    `hot_counts` are the hot_counts_query rows already read from the usages table; archived
+    months are read here. Returns {"buckets": [...], "features": {feature: [counts]}, "totals": {...}}.
+    """
+    width_us = int(BUCKETS[bucket] / timedelta(microseconds=1))
+    start_us = int((start - EPOCH) / timedelta(microseconds=1))
+    n_buckets = int((end - start) / BUCKETS[bucket])
+
+    # Gather (feature label, timestamp, count) columns from every source into arrays
+    feature_parts, ts_parts, weight_parts = [], [], []
+    if hot_counts:
+        features, periods, counts = zip(*hot_counts)
+        feature_parts.append(np.asarray(features, dtype=object))
+        ts_parts.append(_to_us(periods))
+        weight_parts.append(np.asarray(counts, dtype=np.int64))
+    for seg_features, codes, ts in scan_archived_columns(tenant_id, start, end, shard):
+        labels = np.asarray(seg_features, dtype=object)
+        feature_parts.append(labels[np.frombuffer(codes, dtype=np.uint16)])
+        ts_parts.append(np.frombuffer(ts, dtype=np.int64))
+        weight_parts.append(np.ones(len(ts), dtype=np.int64))
+
+    buckets = [(start + BUCKETS[bucket] * i).isoformat() for i in range(n_buckets)]
+    if not feature_parts:
+        return {"buckets": buckets, "features": {}, "totals": {}}
+    labels, codes = np.unique(np.concatenate(feature_parts), return_inverse=True)
+    index = (np.concatenate(ts_parts) - start_us) // width_us
+    counts = np.bincount(codes * n_buckets + index, weights=np.concatenate(weight_parts),
+                         minlength=len(labels) * n_buckets).astype(np.int64).reshape(len(labels), n_buckets)
+    return {
+        "buckets": buckets,
+        "features": {str(f): row.tolist() for f, row in zip(labels, counts)},
+        "totals": {str(f): int(total) for f, total in zip(labels, counts.sum(axis=1))},
+    }
@@ -0,0 +1,353 @@
+"""Time-partitioned usage storage.
+
+The `usages` table is the hot partition: it only keeps the last USAGE_HOT_MONTHS calendar
+months. Older months are archived, per (shard, month), into compressed column-oriented
+segment files under USAGE_ARCHIVE_DIR (part files of up to ARCHIVE_PART_ROWS rows each) and
+then deleted from the hot table, so its size (and with it insert and scan cost) stays flat
+as history grows. Billing reads archived rows from the segments (archived_counts_since),
+as do exports and analytics. The usage_daily rollup, which only feeds /superadmin/stats, is
+left untouched and so keeps covering archived months.
+
+Segment files are zip archives (deflate) holding meta.json plus one packed array per column
+(id, tenant_id, user_id, feature code, timestamp in microseconds). Rows in a part are sorted
+by (tenant_id, timestamp), so a tenant's rows are found by bisecting the tenant_id column.
+
+    python -m app.archive            # archive every shard
+"""
+from sqlalchemy import and_, delete, func, select
+from sqlalchemy.orm import Session
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime, date, timedelta
+import glob, heapq, json, os, zipfile
+import numpy as np
+
+from app.models import Usage
+
+USAGE_HOT_MONTHS = int(os.getenv("USAGE_HOT_MONTHS", "3"))
+USAGE_ARCHIVE_DIR = os.getenv("USAGE_ARCHIVE_DIR", "./usage_archive")
+ARCHIVE_CHUNK_SIZE = 10000
+ARCHIVE_PART_ROWS = int(os.getenv("USAGE_ARCHIVE_PART_ROWS", "200000"))  # rows per segment file (bounds memory)
+EPOCH = datetime(1970, 1, 1)
+DAY_US = 86400 * 1000000
+
+
+def _month_start(d) -> date:
+    return date(d.year, d.month, 1)
+
+def _next_month(d: date) -> date:
+    return date(d.year + (d.month == 12), d.month % 12 + 1, 1)
+
+def _to_micros(ts: datetime) -> int:
+    delta = ts - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _from_micros(us: int) -> datetime:
+    return EPOCH + timedelta(microseconds=us)
+
+
+def hot_cutoff(today: date = None) -> date:
+    """First day of the oldest month that stays in the hot table."""
+    month = _month_start(today or datetime.utcnow().date())
+    for _ in range(USAGE_HOT_MONTHS - 1):
+        month = _month_start(month - timedelta(days=1))
+    return month
+
+
+def write_segment(path: str, shard: str, month: date, rows: list):
+    """Write rows [(id, tenant_id, user_id, feature, timestamp)] as a compressed columnar segment."""
+    rows.sort(key=lambda r: (r[1], r[4]))
+    features = sorted({r[3] for r in rows})
+    codes = {f: i for i, f in enumerate(features)}
+    columns = {
+        "id": array("q", (r[0] for r in rows)),
+        "tenant_id": array("q", (r[1] for r in rows)),
+        "user_id": array("q", (-1 if r[2] is None else r[2] for r in rows)),
+        "feature": array("H", (codes[r[3]] for r in rows)),
+        "timestamp": array("q", (_to_micros(r[4]) for r in rows)),
+    }
+    meta = {
+        "version": 1, "shard": shard, "month": month.isoformat(), "rows": len(rows), "features": features,
+        "min_timestamp": rows[0][4].isoformat() if rows else None,
+        "max_timestamp": max(r[4] for r in rows).isoformat() if rows else None,
+    }
+    tmp_path = path + ".tmp"
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("meta.json", json.dumps(meta))
+        for name, col in columns.items():
+            zf.writestr(f"{name}.bin", col.tobytes())
+    os.replace(tmp_path, path)  # readers never see a half-written segment
+
+
+def read_segment(path: str):
+    """Return (meta, columns) for a segment file."""
+    with zipfile.ZipFile(path) as zf:
+        meta = json.loads(zf.read("meta.json"))
+        columns = {}
+        for name, typecode in (("id", "q"), ("tenant_id", "q"), ("user_id", "q"), ("feature", "H"), ("timestamp", "q")):
+            col = array(typecode)
+            col.frombytes(zf.read(f"{name}.bin"))
+            columns[name] = col
+    return meta, columns
+
+
+def segment_paths(shard: str = None) -> list:
+    pattern = f"usage-{shard}-*.seg" if shard else "usage-*.seg"
+    return sorted(glob.glob(os.path.join(USAGE_ARCHIVE_DIR, pattern)))
+
+
+def _overlaps(meta: dict, start: datetime, end: datetime) -> bool:
+    month = date.fromisoformat(meta["month"])
+    month_start, month_end = datetime.combine(month, datetime.min.time()), datetime.combine(_next_month(month), datetime.min.time())
+    return (end is None or month_start < end) and (start is None or month_end > start)
+
+
+def _segment_month(path: str) -> date:
+    year, month = os.path.basename(path).rsplit("-", 3)[1:3]
+    return date(int(year), int(month), 1)
+
+
+def _segment_events(path: str, tenant_id: int, start: datetime, end: datetime):
+    meta, cols = read_segment(path)
+    lo = bisect_left(cols["tenant_id"], tenant_id)
+    hi = bisect_right(cols["tenant_id"], tenant_id, lo)
+    ts = cols["timestamp"]
+    if start is not None:
+        lo = bisect_left(ts, _to_micros(start), lo, hi)
+    if end is not None:
+        hi = bisect_left(ts, _to_micros(end), lo, hi)
+    ids, users, features = cols["id"], cols["user_id"], meta["features"]
+    # Segments order rows by timestamp only; order equal timestamps by id
+    i = lo
+    while i < hi:
+        j = i + 1
+        while j < hi and ts[j] == ts[i]:
+            j += 1
+        for k in sorted(range(i, j), key=ids.__getitem__):
+            yield (ids[k], _from_micros(ts[k]), features[cols["feature"][k]], None if users[k] < 0 else users[k])
+        i = j
+
+
+def iter_archived_events(tenant_id: int, start: datetime = None, end: datetime = None, shard: str = None):
+    """Yield a tenant's archived (id, timestamp, feature, user_id) rows in [start, end), ordered by (timestamp, id).
+
+    Works month by month, so at most one month's segment files are held in memory.
+    """
+    months = {}
+    for path in segment_paths(shard):
+        months.setdefault(_segment_month(path), []).append(path)
+    for month in sorted(months):
+        if not _overlaps({"month": month.isoformat()}, start, end):
+            continue
+        parts = [_segment_events(path, tenant_id, start, end) for path in months[month]]
+        yield from heapq.merge(*parts, key=lambda row: (row[1], row[0]))
+
+
+def scan_archived_columns(tenant_id: int, start: datetime = None, end: datetime = None, shard: str = None):
+    """Yield (features, feature_codes, timestamps_us) column slices of a tenant's archived rows in [start, end).
+
+    Hands back the packed columns of each segment instead of tuples, for vectorized
+    consumers. Segments outside the range are skipped by file name unread.
+    """
+    for path in segment_paths(shard):
+        if not _overlaps({"month": _segment_month(path).isoformat()}, start, end):
+            continue
+        meta, cols = read_segment(path)
+        lo = bisect_left(cols["tenant_id"], tenant_id)
+        hi = bisect_right(cols["tenant_id"], tenant_id, lo)
+        ts = cols["timestamp"]
+        if start is not None:
+            lo = bisect_left(ts, _to_micros(start), lo, hi)
+        if end is not None:
+            hi = bisect_left(ts, _to_micros(end), lo, hi)
+        if lo < hi:
+            yield meta["features"], cols["feature"][lo:hi], ts[lo:hi]
+
+
+def archived_counts_since(after_ids: dict, through_id: int, shard: str = None, since: datetime = None) -> dict:
+    """{tenant_id: Counter(feature)} of archived rows with after_ids[tenant_id] < id <= through_id.
+
+    Each segment is read once for all tenants. Months that end before `since` are skipped
+    (callers pass the earliest timestamp such rows can have).
+    """
+    counts = {}
+    for path in segment_paths(shard):
+        if since is not None:
+            if datetime.combine(_next_month(_segment_month(path)), datetime.min.time()) <= since:
+                continue
+        meta, cols = read_segment(path)
+        ids, tenants, codes, features = cols["id"], cols["tenant_id"], cols["feature"], meta["features"]
+        for tenant_id, after_id in after_ids.items():
+            lo = bisect_left(tenants, tenant_id)
+            hi = bisect_right(tenants, tenant_id, lo)
+            for i in range(lo, hi):
+                if after_id < ids[i] <= through_id:
+                    counts.setdefault(tenant_id, Counter())[features[codes[i]]] += 1
+    return counts
+
+
+def archived_daily_counts(tenant_id: int = None, shard: str = None) -> Counter:
+    """{(tenant_id, feature, day): count} across archived segments, for rebuilding the rollup."""
+    counts = Counter()
+    for path in segment_paths(shard):
+        meta, cols = read_segment(path)
+        lo, hi = 0, len(cols["id"])
+        if tenant_id is not None:
+            lo = bisect_left(cols["tenant_id"], tenant_id)
+            hi = bisect_right(cols["tenant_id"], tenant_id, lo)
+        if lo == hi:
+            continue
+        # Grouped per segment: one np.unique over the (tenant, feature, day) columns
+        keys = np.stack([np.frombuffer(cols["tenant_id"], dtype=np.int64)[lo:hi],
+                         np.frombuffer(cols["feature"], dtype=np.uint16)[lo:hi].astype(np.int64),
+                         np.frombuffer(cols["timestamp"], dtype=np.int64)[lo:hi] // DAY_US], axis=1)
+        groups, sizes = np.unique(keys, axis=0, return_counts=True)
+        features = meta["features"]
+        for (t, f, day), n in zip(groups.tolist(), sizes.tolist()):
+            counts[(t, features[f], EPOCH.date() + timedelta(days=day))] += n
+    return counts
+
+
+def _tenant_rows_by_id(path: str, tenant_id: int):
+    meta, cols = read_segment(path)
+    lo = bisect_left(cols["tenant_id"], tenant_id)
+    hi = bisect_right(cols["tenant_id"], tenant_id, lo)
+    ids, users, codes, ts = (cols[name][lo:hi] for name in ("id", "user_id", "feature", "timestamp"))
+    del cols
+    features = meta["features"]
+    for k in sorted(range(len(ids)), key=ids.__getitem__):
+        yield ids[k], None if users[k] < 0 else users[k], features[codes[k]], _from_micros(ts[k])
+
+
+def iter_tenant_archive(tenant_id: int, shard: str):
+    """Yield a tenant's archived (id, user_id, feature, timestamp) rows in id order, for moving it between shards.
+
+    The tenant's slice of every segment (not the whole files) is held in memory while merging.
+    """
+    return heapq.merge(*(_tenant_rows_by_id(path, tenant_id) for path in segment_paths(shard)), key=lambda r: r[0])
+
+
+def drop_tenant_archive(tenant_id: int, shard: str) -> int:
+    """Rewrite a shard's segments (pending ones too) without a tenant's rows, deleting emptied files; returns rows dropped."""
+    dropped = 0
+    for path in segment_paths(shard) + pending_paths(shard):
+        meta, cols = read_segment(path)
+        lo = bisect_left(cols["tenant_id"], tenant_id)
+        hi = bisect_right(cols["tenant_id"], tenant_id, lo)
+        if lo == hi:
+            continue
+        features = meta["features"]
+        rows = [(cols["id"][i], cols["tenant_id"][i], None if cols["user_id"][i] < 0 else cols["user_id"][i],
+                 features[cols["feature"][i]], _from_micros(cols["timestamp"][i]))
+                for i in range(len(cols["id"])) if not lo <= i < hi]
+        if rows:
+            write_segment(path, meta["shard"], date.fromisoformat(meta["month"]), rows)
+        else:
+            os.remove(path)
+        dropped += hi - lo
+    return dropped
+
+
+def pending_paths(shard: str = None, month: date = None) -> list:
+    """Part files written but not yet published (their rows may still be in the hot table)."""
+    pattern = f"usage-{shard or '*'}-{month:%Y-%m}-*.seg.pending" if month else f"usage-{shard or '*'}-*.seg.pending"
+    return sorted(glob.glob(os.path.join(USAGE_ARCHIVE_DIR, pattern)))
+
+def _next_part(shard: str, month: date) -> int:
+    paths = glob.glob(os.path.join(USAGE_ARCHIVE_DIR, f"usage-{shard}-{month:%Y-%m}-*.seg")) + pending_paths(shard, month)
+    parts = [int(os.path.basename(path).split(".", 1)[0].rsplit("-", 1)[1]) for path in paths]
+    return max(parts, default=-1) + 1
+
+def _delete_ids(db: Session, in_month, ids):
+    # Exactly the rows written; one transaction, so they leave the hot table all at once
+    for i in range(0, len(ids), ARCHIVE_CHUNK_SIZE):
+        db.execute(delete(Usage).where(in_month, Usage.id.in_(ids[i:i + ARCHIVE_CHUNK_SIZE])))
+    db.commit()
+
+def _in_month(month: date):
+    start = datetime.combine(month, datetime.min.time())
+    end = datetime.combine(_next_month(month), datetime.min.time())
+    return and_(Usage.timestamp >= start, Usage.timestamp < end)
+
+def _publish(db: Session, path: str):
+    """Delete a pending part's rows from the hot table, then make the part visible to readers."""
+    meta, cols = read_segment(path)
+    _delete_ids(db, _in_month(date.fromisoformat(meta["month"])), cols["id"].tolist())
+    os.replace(path, path[:-len(".pending")])
+
+
+def publish_pending(db: Session, shard: str, month: date = None) -> int:
+    """Finish parts left pending by an interrupted archive run; returns the number published."""
+    paths = pending_paths(shard, month)
+    for path in paths:
+        _publish(db, path)
+    return len(paths)
+
+
+def archive_month(db: Session, shard: str, month: date) -> int:
+    """Move one month of usage from the hot table into segment files; returns rows archived.
+
+    Rows are written ARCHIVE_PART_ROWS at a time, one part file each. A part is written as
+    *.seg.pending, which readers ignore, and only renamed to *.seg once its rows are deleted
+    from the hot table, so a row is never counted both hot and archived. Safe to re-run
+    after a crash: pending parts are published first instead of being archived twice.
+    (A crash between the delete's commit and the rename hides that part's rows until the
+    next run publishes it.)
+    """
+    publish_pending(db, shard, month)
+    in_month = _in_month(month)
+    if db.execute(select(Usage.id).where(in_month).limit(1)).first() is None:
+        return 0
+    os.makedirs(USAGE_ARCHIVE_DIR, exist_ok=True)
+    archived, last_id = 0, 0
+    while True:
+        rows = [tuple(r) for r in db.execute(
+            select(Usage.id, Usage.tenant_id, Usage.user_id, Usage.feature, Usage.timestamp)
+            .where(in_month, Usage.id > last_id)
+            .order_by(Usage.id)
+            .limit(ARCHIVE_PART_ROWS)
+        )]
+        if not rows:
+            return archived
+        ids = [r[0] for r in rows]
+        # A month archived again (late rows) gets extra part files rather than rewriting the first
+        path = os.path.join(USAGE_ARCHIVE_DIR, f"usage-{shard}-{month:%Y-%m}-{_next_part(shard, month)}.seg.pending")
+        write_segment(path, shard, month, rows)
+        _delete_ids(db, in_month, ids)
+        os.replace(path, path[:-len(".pending")])
+        archived += len(ids)
+        last_id = ids[-1]
+
+
+def archive_cold_usage(db: Session, shard: str, today: date = None) -> dict:
+    """Archive every month older than the hot window on one shard."""
+    publish_pending(db, shard)
+    cutoff = datetime.combine(hot_cutoff(today), datetime.min.time())
+    oldest = db.execute(select(func.min(Usage.timestamp)).where(Usage.timestamp < cutoff)).scalar()
+    archived = {}
+    if oldest is None:
+        return archived
+    month = _month_start(oldest)
+    while month < cutoff.date():
+        count = archive_month(db, shard, month)
+        if count:
+            archived[month.isoformat()] = count
+        month = _next_month(month)
+    return archived
+
+
+def archive_all_shards(today: date = None) -> dict:
+    from app.sharding import get_shard, shard_names
+    results = {}
+    for name in shard_names():
+        db = get_shard(name).SessionLocal()
+        try:
+            results[name] = archive_cold_usage(db, name, today)
+        finally:
+            db.close()
+    return results
+
+
+if __name__ == "__main__":
+    print(archive_all_shards())
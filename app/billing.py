@@ -0,0 +1,146 @@
+"""Incremental usage billing from per-tenant watermarks.
+
+Each tenant has a BillingWatermark on its shard: usage rows with id <= last_usage_id have
+been billed. A bill counts the rows above the watermark, records a BillingPeriod and moves
+the watermark with a compare-and-set in the same transaction, so a repeated or concurrent
+run bills nothing twice. On-demand bills (bill_tenant) and the monthly cycle
+(run_billing_cycle) both go through bill_tenants, so the watermark is the one record of
+what has been billed. Statement emails are sent from the BillingPeriod rows afterwards
+(queue_bill_emails in app/tasks/billing.py), so a bill committed just before a crash is
+still emailed by the next run.
+
+Auto-increment ids are handed out at insert time but become visible at commit, so max(id)
+can run ahead of a lower id that is still in flight. A bill therefore stops at a fence: the
+shard's max(id) as recorded at least BILLING_SETTLE_SECONDS earlier (the beat schedule
+records one per shard every USAGE_FENCE_INTERVAL), by which time every lower id has
+committed.
+"""
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from collections import Counter
+from datetime import datetime, timedelta
+import json, os
+
+from app.archive import archived_counts_since
+from app.models import BillingPeriod, BillingWatermark, Usage, UsageFence, User
+
+BILLING_SETTLE_SECONDS = float(os.getenv("BILLING_SETTLE_SECONDS", "60"))
+USAGE_FENCE_RETENTION = timedelta(days=1)
+# Usage may be stamped up to this long before it is received (see MAX_BACKDATE in app/routers/tenant.py)
+BILLING_MAX_BACKDATE = timedelta(days=1)
+
+
+def record_fence(db: Session, now: datetime = None) -> int:
+    """Record the shard's current max usage id as a fence; returns it."""
+    now = now or datetime.utcnow()
+    max_id = db.execute(select(func.max(Usage.id))).scalar() or 0
+    db.add(UsageFence(max_usage_id=max_id, taken_at=now))
+    db.query(UsageFence).filter(UsageFence.taken_at < now - USAGE_FENCE_RETENTION).delete(synchronize_session=False)
+    db.commit()
+    return max_id
+
+
+def settled_fence(db: Session, now: datetime = None):
+    """Usage id up to which every row is committed (the newest settled fence), or None if there is none yet.
+
+    Records a fence when none is pending, so a caller that gets None can retry after
+    BILLING_SETTLE_SECONDS.
+    """
+    now = now or datetime.utcnow()
+    settled_at = now - timedelta(seconds=BILLING_SETTLE_SECONDS)
+    newest = db.execute(select(UsageFence.max_usage_id, UsageFence.taken_at)
+                        .order_by(UsageFence.taken_at.desc()).limit(1)).first()
+    if newest is None:
+        record_fence(db, now)
+    elif newest.taken_at <= settled_at:
+        return newest.max_usage_id
+    return db.execute(select(UsageFence.max_usage_id).where(UsageFence.taken_at <= settled_at)
+                      .order_by(UsageFence.taken_at.desc()).limit(1)).scalar()
+
+
+def _ensure_watermarks(db: Session, tenant_ids: list):
+    while True:
+        existing = set(db.execute(select(BillingWatermark.tenant_id)
+                                  .where(BillingWatermark.tenant_id.in_(tenant_ids))).scalars())
+        missing = [tenant_id for tenant_id in tenant_ids if tenant_id not in existing]
+        if not missing:
+            return
+        try:
+            db.add_all([BillingWatermark(tenant_id=tenant_id, last_usage_id=0) for tenant_id in missing])
+            db.commit()
+            return
+        except IntegrityError:
+            db.rollback()  # some were created by a concurrent run; add the rest
+
+
+def bill_tenants(db: Session, shard: str, tenant_ids: list, through_id: int, now: datetime = None,
+                 run: str = None) -> dict:
+    """Bill each tenant's usage with id in (watermark, through_id]; returns {tenant_id: {feature: count}}.
+
+    Tenants with nothing new, or whose watermark moved concurrently, are left out of the result.
+    A billing cycle passes its `run` instead: every tenant then gets a bill (a zero statement if
+    nothing is new), except tenants the run has already billed.
+    """
+    now = now or datetime.utcnow()
+    if run is not None:
+        done = set(db.execute(select(BillingPeriod.tenant_id)
+                              .where(BillingPeriod.tenant_id.in_(tenant_ids), BillingPeriod.run == run)).scalars())
+        tenant_ids = [tenant_id for tenant_id in tenant_ids if tenant_id not in done]
+        if not tenant_ids:
+            return {}
+    _ensure_watermarks(db, tenant_ids)
+    watermarks = {tenant_id: (last_usage_id, billed_until) for tenant_id, last_usage_id, billed_until in db.execute(
+        select(BillingWatermark.tenant_id, BillingWatermark.last_usage_id, BillingWatermark.billed_until)
+        .where(BillingWatermark.tenant_id.in_(tenant_ids))
+    )}
+    counts = {}
+    rows = db.execute(
+        select(Usage.tenant_id, Usage.feature, func.count(Usage.id))
+        .join(BillingWatermark, BillingWatermark.tenant_id == Usage.tenant_id)
+        .where(Usage.tenant_id.in_(tenant_ids), Usage.id > BillingWatermark.last_usage_id, Usage.id <= through_id)
+        .group_by(Usage.tenant_id, Usage.feature)
+    )
+    for tenant_id, feature, count in rows:
+        counts.setdefault(tenant_id, Counter())[feature] += count
+    # Unbilled rows may already have been moved to the archive; months that end before the
+    # earliest such row can be stamped are skipped
+    starts = [billed_until for _, billed_until in watermarks.values()]
+    since = min(starts) - BILLING_MAX_BACKDATE if starts and None not in starts else None
+    after_ids = {tenant_id: last_usage_id for tenant_id, (last_usage_id, _) in watermarks.items()}
+    for tenant_id, archived in archived_counts_since(after_ids, through_id, shard=shard, since=since).items():
+        counts.setdefault(tenant_id, Counter()).update(archived)
+
+    if run is not None:
+        counts = {tenant_id: counts.get(tenant_id, Counter()) for tenant_id in tenant_ids}
+    billed = {}
+    for tenant_id, tenant_counts in counts.items():
+        after_id, period_start = watermarks[tenant_id]
+        moved = db.execute(
+            update(BillingWatermark)
+            .where(BillingWatermark.tenant_id == tenant_id, BillingWatermark.last_usage_id == after_id)
+            .values(last_usage_id=through_id, billed_until=now, updated_at=now)
+        ).rowcount
+        if not moved:
+            continue  # billed by a concurrent run
+        tenant_counts = dict(tenant_counts)
+        db.add(BillingPeriod(tenant_id=tenant_id, from_usage_id=after_id, to_usage_id=through_id,
+                             period_start=period_start, period_end=now,
+                             usage=json.dumps(tenant_counts, sort_keys=True), total_usage=sum(tenant_counts.values()),
+                             run=run))
+        billed[tenant_id] = tenant_counts
+    db.commit()
+    return billed
+
+
+def billing_contacts(db: Session, tenant_ids: list) -> dict:
+    """{tenant_id: email} of each tenant's first admin."""
+    contacts = {}
+    admins = db.execute(
+        select(User.tenant_id, User.email)
+        .where(User.tenant_id.in_(tenant_ids), User.is_tenant_admin == True)
+        .order_by(User.id)
+    )
+    for tenant_id, email in admins:
+        contacts.setdefault(tenant_id, email)
+    return contacts
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from threading import Lock
+import os, time
+
+# Sentinel returned by TTLCache.get when a key is absent or expired
+MISSING = object()
+
+
+class TTLCache:
+    """Small thread-safe LRU cache with a per-entry time-to-live.
+
+    Values may be None, which lets callers store negative lookups
+    (e.g. "this subdomain does not exist") alongside positive ones.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class TenantSnapshot:
+    """Detached, read-only copy of a Tenant row, safe to share across requests/sessions."""
+
+    __slots__ = ("id", "name", "subdomain", "plan_id", "shard", "created_at")
+
+    def __init__(self, id, name, subdomain, plan_id, shard, created_at):
+        self.id = id
+        self.name = name
+        self.subdomain = subdomain
+        self.plan_id = plan_id
+        self.shard = shard
+        self.created_at = created_at
+
+    @classmethod
+    def from_orm(cls, tenant):
+        return cls(tenant.id, tenant.name, tenant.subdomain, tenant.plan_id, tenant.shard, tenant.created_at)
+
+
+class UserSnapshot:
+    """Detached copy of the User fields needed by request handlers."""
+
+    def __init__(self, id, email, name, is_superadmin, is_tenant_admin, tenant_id, created_at, token_version):
+        self.id = id
+        self.email = email
+        self.name = name
+        self.is_superadmin = is_superadmin
+        self.is_tenant_admin = is_tenant_admin
+        self.tenant_id = tenant_id
+        self.created_at = created_at
+        self.token_version = token_version
+
+    @classmethod
+    def from_orm(cls, user):
+        return cls(user.id, user.email, user.name, bool(user.is_superadmin), bool(user.is_tenant_admin),
+                   user.tenant_id, user.created_at, user.token_version or 0)
+
+
+# subdomain -> TenantSnapshot (or None for unknown subdomains). Changing a tenant (e.g. its
+# plan via /tenant/plan/select or the superadmin endpoints) only invalidates the entry in the
+# worker that made the change; other workers keep the old snapshot, and so the old plan_id
+# (a 402 "No plan selected" or the previous plan's limits), for up to TENANT_CACHE_TTL seconds.
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "1024"))
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "60"))
+TENANT_CACHE_NEGATIVE_TTL = float(os.getenv("TENANT_CACHE_NEGATIVE_TTL", "5"))
+tenant_cache = TTLCache(maxsize=TENANT_CACHE_SIZE, ttl=TENANT_CACHE_TTL)
+
+# tenant_id -> shard name, for requests that only know the tenant id (e.g. from a token)
+tenant_shard_cache = TTLCache(maxsize=TENANT_CACHE_SIZE, ttl=TENANT_CACHE_TTL)
+
+# (shard, tenant_id, user_id) -> UserSnapshot, used by claims-based authentication
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "4096"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Admin entries expire sooner, bounding how long another worker honours a revoked admin token
+USER_CACHE_ADMIN_TTL = float(os.getenv("USER_CACHE_ADMIN_TTL", "5"))
+
+# (tenant_id, shard, start, end, bucket, tenant's max usage id) -> usage analytics response body
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "1024"))
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "300"))
+analytics_cache = TTLCache(maxsize=ANALYTICS_CACHE_SIZE, ttl=ANALYTICS_CACHE_TTL)
+
+# tenant_id -> True for a few seconds after billing was queued, to drop double-clicks
+billing_triggers = TTLCache(maxsize=TENANT_CACHE_SIZE, ttl=float(os.getenv("BILLING_TRIGGER_COOLDOWN", "10")))
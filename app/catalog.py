@@ -0,0 +1,57 @@
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+from app.models import Plan
+from app.schemas import PlanListAdapter
+from threading import Lock
+import hashlib, os, time
+
+# Plans are few and almost never change, so each worker keeps them in memory. create_plan
+# invalidates the local copy; other workers pick the change up after PLAN_CATALOG_TTL seconds.
+PLAN_CATALOG_TTL = float(os.getenv("PLAN_CATALOG_TTL", "60"))
+
+
+class PlanCatalog:
+    """In-memory plan list with a pre-serialized JSON body and strong ETag."""
+
+    def __init__(self, ttl: float = PLAN_CATALOG_TTL):
+        self.ttl = ttl
+        self.plans = {}        # plan id -> {"id", "name", "max_features", rate limits}
+        self.body = b"[]"      # serialized plan list, as returned by the listing endpoints
+        self.etag = None
+        self._loaded_at = None
+        self._lock = Lock()
+
+    def load(self, db: Session):
+        rows = db.query(Plan.id, Plan.name, Plan.max_features,
+                        Plan.tenant_rate_per_minute, Plan.feature_rate_per_minute).order_by(Plan.id).all()
+        plans = [{"id": r.id, "name": r.name, "max_features": r.max_features,
+                  "tenant_rate_per_minute": r.tenant_rate_per_minute,
+                  "feature_rate_per_minute": r.feature_rate_per_minute} for r in rows]
+        body = PlanListAdapter.dump_json(PlanListAdapter.validate_python(plans))
+        with self._lock:
+            self.plans = {p["id"]: p for p in plans}
+            self.body = body
+            self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            self._loaded_at = time.monotonic()
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def get(self, plan_id: int):
+        return self.plans.get(plan_id)
+
+
+def plan_list_response(request: Request, catalog: PlanCatalog) -> Response:
+    """Serve the cached plan list, answering 304 when the client already has this version."""
+    headers = {"ETag": catalog.etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if catalog.etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
+
+
+plan_catalog = PlanCatalog()
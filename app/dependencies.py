@@ -1,10 +1,15 @@
 from fastapi import Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
 from app import models, security
-from app.models import Base, User, Tenant
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import os, time
+from app.cache import (tenant_cache, tenant_shard_cache, user_cache, TenantSnapshot, UserSnapshot, MISSING,
+                       TENANT_CACHE_NEGATIVE_TTL, USER_CACHE_ADMIN_TTL)
+from app.sharding import DEFAULT_SHARD, async_url, get_shard
+from app.replicas import routed_sessionmaker, from_replica, primary_session
+from app.catalog import plan_catalog
+import copy
+from app.models import User, Tenant
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+import os
 
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL")  # Optionally use a single URL env var
@@ -17,27 +22,34 @@ if not DATABASE_URL:
     DATABASE_URL = f"mysql+pymysql://{db_user}:{db_pass}@{db_host}/{db_name}"
 # Note: using PyMySQL driver for MySQL
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Create tables (for dev/demo purposes; in production use migrations)
-try:
-    Base.metadata.create_all(bind=engine)
-except Exception as e:
-    # If DB is not ready, we can retry a few times
-    retries = 5
-    while retries:
-        time.sleep(3)
-        try:
-            Base.metadata.create_all(bind=engine)
-            break
-        except Exception as err:
-            retries -= 1
-            if retries == 0:
-                print("Error: Could not create tables:", err)
-                raise
-
-# Dependency to get DB session
+# Async URL for request handlers: aiomysql in production, aiosqlite for tests
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+if not ASYNC_DATABASE_URL:
+    ASYNC_DATABASE_URL = async_url(DATABASE_URL)
+
+# Engines are created lazily by app.sharding (the primary database is the "default" shard),
+# so importing the app does no DB work. Tables and seed data are handled by app/setup.py.
+def get_engine():
+    return get_shard(DEFAULT_SHARD).engine
+
+def get_async_engine():
+    return get_shard(DEFAULT_SHARD).async_engine
+
+def SessionLocal():
+    return get_shard(DEFAULT_SHARD).SessionLocal()
+
+def AsyncSessionLocal():
+    return get_shard(DEFAULT_SHARD).AsyncSessionLocal()
+
+def __getattr__(name):
+    # Backwards-compatible `from app.dependencies import engine, async_engine`
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Dependency to get DB session (sync; used by startup, Celery tasks and background threads)
 def get_db():
     db = SessionLocal()
     try:
@@ -45,10 +57,78 @@ def get_db():
     finally:
         db.close()
 
+# Dependency to get an async DB session (used by all request handlers).
+# GET/HEAD requests are served by a read replica when one is configured and fresh enough;
+# any other request goes to the primary and pins the client to it briefly (read-your-writes).
+async def get_async_db(request: Request):
+    session_factory = await routed_sessionmaker(request, DEFAULT_SHARD)
+    async with session_factory() as db:
+        yield db
+
+# Dependency for read-only handlers: a replica session whatever the HTTP method
+async def get_read_db(request: Request):
+    session_factory = await routed_sessionmaker(request, DEFAULT_SHARD, read_only=True)
+    async with session_factory() as db:
+        yield db
+
+async def tenant_shard(db: AsyncSession, tenant_id: int) -> str:
+    """Shard name for a tenant id, looked up in the directory (cached)."""
+    shard = tenant_shard_cache.get(tenant_id)
+    if shard is MISSING:
+        shard = (await db.execute(select(Tenant.shard).where(Tenant.id == tenant_id))).scalar()
+        if shard is None and from_replica(db):
+            async with primary_session(db) as primary:
+                shard = (await primary.execute(select(Tenant.shard).where(Tenant.id == tenant_id))).scalar()
+        if shard is None:
+            return None
+        tenant_shard_cache.set(tenant_id, shard)
+    return shard
+
+async def _load_user(payload: dict, db: AsyncSession):
+    user_id = payload["user_id"]
+    if security.AUTH_CLAIMS_MODE and "ver" in payload:
+        return await _user_from_claims(payload, db)
+    # Fetch user from DB
+    return (await db.execute(select(User).where(User.id == user_id))).scalars().first()
+
+async def _user_from_claims(payload: dict, db: AsyncSession):
+    """Resolve a claims token against the versioned user cache, hitting the DB only on a miss or version bump."""
+    user_id = payload["user_id"]
+    token_version = payload["ver"]
+    # User ids are only unique within a shard (and change when a tenant moves), so key by both
+    key = (payload.get("shard", DEFAULT_SHARD), payload.get("tenant_id"), user_id)
+    cached = user_cache.get(key)
+    if cached is MISSING or cached.token_version < token_version:
+        row = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
+        if from_replica(db) and (row is None or row.token_version < token_version):
+            # The replica hasn't caught up with the login that issued this token
+            async with primary_session(db) as primary:
+                row = (await primary.execute(select(User).where(User.id == user_id))).scalars().first()
+        if not row:
+            return None
+        cached = UserSnapshot.from_orm(row)
+        user_cache.set(key, cached, ttl=USER_CACHE_ADMIN_TTL if row.is_superadmin or row.is_tenant_admin else None)
+    if cached.token_version != token_version:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
+    if (cached.tenant_id != payload.get("tenant_id")
+            or cached.is_superadmin != payload.get("is_superadmin")
+            or cached.is_tenant_admin != payload.get("is_tenant_admin")):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token claims are stale")
+    # Copy so the per-request token_payload never leaks into the shared cache entry
+    return copy.copy(cached)
+
+async def revoke_user_tokens(db: AsyncSession, user: User):
+    """Invalidate every token issued to a user (call after a password change or demotion).
+
+    Other workers notice once their cached entry expires (see AUTH_CLAIMS_MODE in app/security.py).
+    """
+    await db.execute(update(User).where(User.id == user.id).values(token_version=User.token_version + 1))
+    user_cache.invalidate((db.sync_session.info.get("shard", DEFAULT_SHARD), user.tenant_id, user.id))
+
 # Dependency to get current user from token
-def get_current_user(token: str = Depends(lambda: None),  # placeholder, will override in router
-                     db: Session = Depends(get_db),
-                     request: Request = None):
+async def get_current_user(token: str = Depends(lambda: None),  # placeholder, will override in router
+                           db: AsyncSession = Depends(get_async_db),
+                           request: Request = None):
     # We will manually extract token from Authorization header since we can't easily inject OAuth2 in two contexts
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
@@ -61,21 +141,31 @@ def get_current_user(token: str = Depends(lambda: None),  # placeholder, will ov
     user_id: int = payload.get("user_id")
     if user_id is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token payload")
-    # Fetch user from DB
-    user = db.query(User).filter(User.id == user_id).first()
+    # Tenant users live on their tenant's shard; superadmins live in the directory
+    tenant_id = payload.get("tenant_id")
+    shard = await tenant_shard(db, tenant_id) if tenant_id is not None else DEFAULT_SHARD
+    if shard is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+    # After a move the tenant's users have new ids, so an older token's user_id may now
+    # belong to someone else on the new shard
+    if tenant_id is not None and payload.get("shard") != shard:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired, please log in again")
+    if shard == DEFAULT_SHARD:
+        user = await _load_user(payload, db)
+    else:
+        async with (await routed_sessionmaker(request, shard))() as shard_db:
+            user = await _load_user(payload, shard_db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    # If token is from a tenant user, ensure tenant matches the subdomain (for extra security)
-    tenant_id = payload.get("tenant_id")
-    if user.is_superadmin:
-        # Superadmin token should not have a tenant_id
-        tenant_id = None
+    # The user must belong to the tenant the token was issued for (superadmins have none)
+    if user.tenant_id != tenant_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
     # Attach the token payload info to user object for reference
     user.token_payload = payload
     return user
 
 # Dependency to get current tenant based on subdomain (Host header)
-def get_current_tenant(request: Request, db: Session = Depends(get_db)):
+async def get_current_tenant(request: Request, db: AsyncSession = Depends(get_async_db)):
     host = request.headers.get("host")
     if not host:
         raise HTTPException(status_code=400, detail="Bad request: no host header")
@@ -96,7 +186,32 @@ def get_current_tenant(request: Request, db: Session = Depends(get_db)):
             subdomain = parts[0]
     if not subdomain:
         return None
-    tenant = db.query(Tenant).filter(Tenant.subdomain == subdomain).first()
+    # Serve hot subdomains from the in-process cache (negative entries are cached as None)
+    tenant = tenant_cache.get(subdomain)
+    if tenant is MISSING:
+        row = (await db.execute(select(Tenant).where(Tenant.subdomain == subdomain))).scalars().first()
+        if row is None and from_replica(db):
+            # Don't cache "not found" for a tenant the replica simply hasn't seen yet
+            async with primary_session(db) as primary:
+                row = (await primary.execute(select(Tenant).where(Tenant.subdomain == subdomain))).scalars().first()
+        if row:
+            tenant = TenantSnapshot.from_orm(row)
+            tenant_cache.set(subdomain, tenant)
+        else:
+            tenant = None
+            tenant_cache.set(subdomain, None, ttl=TENANT_CACHE_NEGATIVE_TTL)
     if not tenant:
         raise HTTPException(status_code=404, detail="Tenant not found")
     return tenant
+
+# Dependency that makes sure the in-memory plan catalog is loaded and fresh
+async def get_plan_catalog(db: AsyncSession = Depends(get_async_db)):
+    if plan_catalog.is_stale():
+        await db.run_sync(plan_catalog.load)
+    return plan_catalog
+
+# Dependency to get a DB session on the current tenant's shard (directory session outside a tenant)
+async def get_tenant_db(request: Request, tenant: Tenant = Depends(get_current_tenant)):
+    session_factory = await routed_sessionmaker(request, tenant.shard if tenant is not None else DEFAULT_SHARD)
+    async with session_factory() as db:
+        yield db
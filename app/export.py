@@ -0,0 +1,108 @@
+"""Streaming export of a tenant's raw usage events (CSV or NDJSON, optionally gzipped).
+
+Rows are emitted in (timestamp, id) order: archived months first, read from their segment
+files, then the hot table through a server-side cursor, EXPORT_CHUNK_SIZE rows at a time.
+Memory stays bounded by one chunk (plus one archived month) however long the export is.
+
+Every row carries its id and timestamp, so an interrupted download is resumed by passing
+the last row received as `after=<timestamp>,<id>`.
+"""
+from datetime import datetime
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, or_, select
+from starlette.concurrency import iterate_in_threadpool
+import csv, io, os, zlib
+import orjson
+
+from app.archive import iter_archived_events
+from app.ingest import utc_naive
+from app.models import Usage
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+EXPORT_FIELDS = ("id", "timestamp", "feature", "user_id")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def parse_cursor(value: str):
+    """Parse an `after` cursor "<ISO timestamp>,<id>" into (datetime, id); 400 if malformed."""
+    if value is None:
+        return None
+    try:
+        timestamp, _, usage_id = value.rpartition(",")
+        return utc_naive(datetime.fromisoformat(timestamp)), int(usage_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="after must be '<timestamp>,<id>' of the last row received")
+
+
+def _encode(rows: list, fmt: str, header: bool) -> bytes:
+    if fmt == "ndjson":
+        return b"".join(orjson.dumps(dict(zip(EXPORT_FIELDS, row))) + b"\n" for row in rows)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    writer.writerows((i, ts.isoformat(), feature, "" if user_id is None else user_id)
+                     for i, ts, feature, user_id in rows)
+    return buf.getvalue().encode()
+
+
+def _archived_chunks(tenant_id: int, shard: str, start: datetime, end: datetime, after, chunk_size: int):
+    if after is not None:
+        start = after[0] if start is None else max(start, after[0])
+    chunk = []
+    for row in iter_archived_events(tenant_id, start, end, shard):
+        if after is not None and (row[1], row[0]) <= after:
+            continue
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_statement(tenant_id: int, start: datetime = None, end: datetime = None, after=None):
+    stmt = select(Usage.id, Usage.timestamp, Usage.feature, Usage.user_id).where(Usage.tenant_id == tenant_id)
+    if start is not None:
+        stmt = stmt.where(Usage.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(Usage.timestamp < end)
+    if after is not None:
+        # Keyset condition on (timestamp, id), written out so it works on every backend
+        stmt = stmt.where(or_(Usage.timestamp > after[0], and_(Usage.timestamp == after[0], Usage.id > after[1])))
+    return stmt.order_by(Usage.timestamp, Usage.id)
+
+
+def usage_export_response(session_factory, tenant_id: int, shard: str, filename: str, fmt: str = "csv",
+                          compress: bool = False, start: datetime = None, end: datetime = None, after=None,
+                          chunk_size: int = EXPORT_CHUNK_SIZE) -> StreamingResponse:
+    """StreamingResponse exporting a tenant's usage; the generator owns its own session."""
+    start, end = utc_naive(start), utc_naive(end)
+
+    async def chunks():
+        header = fmt == "csv"
+        async for rows in iterate_in_threadpool(_archived_chunks(tenant_id, shard, start, end, after, chunk_size)):
+            yield _encode(rows, fmt, header)
+            header = False
+        async with session_factory() as db:
+            result = await db.stream(export_statement(tenant_id, start, end, after)
+                                     .execution_options(yield_per=chunk_size))
+            async for rows in result.partitions(chunk_size):
+                yield _encode(rows, fmt, header)
+                header = False
+        if header:
+            yield _encode([], fmt, header)  # CSV header even for an empty export
+
+    async def gzipped():
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+        async for data in chunks():
+            out = compressor.compress(data)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    filename = f"{filename}.{fmt}" + (".gz" if compress else "")
+    return StreamingResponse(gzipped() if compress else chunks(),
+                             media_type="application/gzip" if compress else MEDIA_TYPES[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
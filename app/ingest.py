@@ -0,0 +1,180 @@
+from app.models import Usage
+from app.rollup import rollup_counts, apply_rollup
+from app.sharding import DEFAULT_SHARD, get_shard
+from datetime import datetime
+from threading import Thread, Lock
+import os, queue, time
+
+# Write-behind ingestion for feature usage. When enabled, /tenant/features/use enqueues rows
+# here and a background thread bulk-inserts them, trading a small durability window
+# (at most USAGE_FLUSH_INTERVAL seconds / USAGE_FLUSH_ROWS rows) for write throughput.
+# A batch whose insert fails is retried with backoff and only dropped once it has kept
+# failing for USAGE_FLUSH_RETRY_SECONDS (or at shutdown), which bounds the window during an
+# outage. While failed rows fill the buffer's capacity, new rows stay queued, so producers
+# get backpressure instead of the buffer growing.
+USAGE_BUFFER_ENABLED = os.getenv("USAGE_BUFFER_ENABLED", "0").lower() in ("1", "true", "yes")
+USAGE_BUFFER_SIZE = int(os.getenv("USAGE_BUFFER_SIZE", "10000"))          # max rows held in memory
+USAGE_FLUSH_ROWS = int(os.getenv("USAGE_FLUSH_ROWS", "500"))              # flush when this many are queued
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))    # ... or after this many seconds
+USAGE_ENQUEUE_TIMEOUT = float(os.getenv("USAGE_ENQUEUE_TIMEOUT", "0.5"))  # backpressure wait before rejecting
+USAGE_FLUSH_RETRY_SECONDS = float(os.getenv("USAGE_FLUSH_RETRY_SECONDS", "60"))  # retry a failed batch this long
+USAGE_FLUSH_BACKOFF_MAX = 5.0  # seconds between retries of a failed batch, at most
+
+
+def utc_naive(ts: datetime) -> datetime:
+    # Usage timestamps are stored as naive UTC
+    if ts is not None and ts.tzinfo is not None:
+        ts = (ts - ts.utcoffset()).replace(tzinfo=None)
+    return ts
+
+
+class UsageBuffer:
+    """Bounded in-process buffer of Usage rows, flushed in bulk by a background thread."""
+
+    def __init__(self, session_factory, maxsize: int = USAGE_BUFFER_SIZE,
+                 flush_rows: int = USAGE_FLUSH_ROWS, flush_interval: float = USAGE_FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = False
+        self._thread = None
+        self._stats_lock = Lock()
+        self._flush_lock = Lock()
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.last_flush_rows = 0
+        self.last_flush_seconds = 0.0
+        self.rejected = 0
+        self.errors = 0
+        self.dropped = 0
+        # Batches whose insert failed: {"shard", "rows", "failed_at", "attempts", "retry_at"}
+        self._failed = []
+        self.retrying = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stop = False
+            self._thread = Thread(target=self._run, name="usage-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and drain everything still queued (failed batches get one last attempt)."""
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(final=True)
+
+    def add(self, tenant_id: int, user_id: int, feature: str, timestamp: datetime = None,
+            shard: str = DEFAULT_SHARD, block: bool = True):
+        """Queue one usage row. When full, blocks briefly (if `block`) and raises queue.Full if it stays full."""
+        row = {"tenant_id": tenant_id, "user_id": user_id, "feature": feature,
+               "timestamp": timestamp or datetime.utcnow()}
+        try:
+            self._queue.put((shard, row), block=block, timeout=USAGE_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            if block:
+                with self._stats_lock:
+                    self.rejected += 1
+            raise
+
+    def _write(self, shard: str, rows: list):
+        """Insert one shard's rows and their rollup in one transaction; returns the error, if any."""
+        db = self.session_factory(shard)
+        try:
+            db.bulk_insert_mappings(Usage, rows)
+            apply_rollup(db, rollup_counts(rows))
+            db.commit()
+        except Exception as err:
+            db.rollback()
+            return err
+        finally:
+            db.close()
+
+    def _retry_due(self, now: float) -> bool:
+        return any(batch["retry_at"] <= now for batch in self._failed)
+
+    def flush(self, final: bool = False) -> int:
+        """Bulk insert everything queued plus failed batches due for a retry; returns the number of rows written."""
+        with self._flush_lock:
+            now = time.monotonic()
+            batches = [b for b in self._failed if final or b["retry_at"] <= now]
+            self._failed = [b for b in self._failed if not (final or b["retry_at"] <= now)]
+            rows = []
+            while self.retrying + len(rows) < self._queue.maxsize or final:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not rows and not batches:
+                return 0
+            started = time.perf_counter()
+            by_shard = {}
+            for shard, row in rows:
+                by_shard.setdefault(shard, []).append(row)
+            batches += [{"shard": shard, "rows": shard_rows, "failed_at": None, "attempts": 0}
+                        for shard, shard_rows in by_shard.items()]
+            written = 0
+            for batch in batches:
+                shard, batch_rows = batch["shard"], batch["rows"]
+                if batch["failed_at"] is not None:
+                    self.retrying -= len(batch_rows)
+                err = self._write(shard, batch_rows)
+                if err is None:
+                    written += len(batch_rows)
+                    continue
+                failed_at = batch["failed_at"] if batch["failed_at"] is not None else now
+                attempts = batch["attempts"] + 1
+                with self._stats_lock:
+                    self.errors += 1
+                if final or now - failed_at >= USAGE_FLUSH_RETRY_SECONDS:
+                    with self._stats_lock:
+                        self.dropped += len(batch_rows)
+                    print("Error: usage flush failed on shard", shard, f"({attempts} attempts), dropping",
+                          len(batch_rows), "rows:", err)
+                    continue
+                self._failed.append({"shard": shard, "rows": batch_rows, "failed_at": failed_at, "attempts": attempts,
+                                     "retry_at": now + min(USAGE_FLUSH_BACKOFF_MAX, 0.5 * 2 ** (attempts - 1))})
+                self.retrying += len(batch_rows)
+                print("Error: usage flush failed on shard", shard, f"(attempt {attempts}), will retry",
+                      len(batch_rows), "rows:", err)
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                self.flushes += 1
+                self.rows_flushed += written
+                self.last_flush_rows = written
+                self.last_flush_seconds = elapsed
+            return written
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stop:
+            time.sleep(min(0.05, self.flush_interval))
+            now = time.monotonic()
+            if self._queue.qsize() >= self.flush_rows or now - last_flush >= self.flush_interval or self._retry_due(now):
+                self.flush()
+                last_flush = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "depth": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+                "last_flush_rows": self.last_flush_rows,
+                "last_flush_seconds": self.last_flush_seconds,
+                "avg_rows_per_flush": (self.rows_flushed / self.flushes) if self.flushes else 0.0,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "retrying": self.retrying,
+                "dropped": self.dropped,
+            }
+
+
+def _session_factory(shard: str):
+    return get_shard(shard).SessionLocal()
+
+
+usage_buffer = UsageBuffer(_session_factory)
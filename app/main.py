@@ -1,11 +1,20 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 from app.routers import superadmin, tenant
-from app.dependencies import get_current_tenant, get_current_user, engine
-from app import models
-import os
+from app.dependencies import get_async_engine
+from app import security
+from app.ingest import usage_buffer, USAGE_BUFFER_ENABLED
+from app.cache import tenant_cache, user_cache
+from app.metrics import MetricsMiddleware, registry
+from app.replicas import StickyWritesMiddleware, replica_status
+from app.setup import setup_state, start_background_setup
+from sqlalchemy import text
+import app as app_package
+import asyncio, os, time
 
-app = FastAPI(title="Multi-Tenant SaaS API")
+# orjson-backed responses for every route by default
+app = FastAPI(title="Multi-Tenant SaaS API", default_response_class=ORJSONResponse)
 
 # Include routers
 app.include_router(superadmin.router)
@@ -20,31 +29,74 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create initial superadmin and default plans if not already present (one-time setup)
+# Read-your-writes: tells clients that wrote when, so any worker pins their reads to the primary
+app.add_middleware(StickyWritesMiddleware)
+
+# Per-route latency / SQL / pool-wait metrics and Server-Timing header
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    lines = [registry.render()]
+    for name, cache in (("tenant", tenant_cache), ("user", user_cache)):
+        stats = cache.stats()
+        lines.append(f'app_cache_hits_total{{cache="{name}"}} {stats["hits"]}\n')
+        lines.append(f'app_cache_misses_total{{cache="{name}"}} {stats["misses"]}\n')
+    for i, replica in enumerate(replica_status()):
+        if replica["lag"] is not None:
+            lines.append(f'app_replica_lag_seconds{{shard="{replica["shard"]}",replica="{i}"}} {replica["lag"]}\n')
+    return PlainTextResponse("".join(lines), media_type="text/plain; version=0.0.4")
+
+# A login storm beyond the hashing queue is shed instead of queued without limit
+@app.exception_handler(security.HashingBusy)
+async def hashing_busy_handler(request: Request, exc: security.HashingBusy):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+# Cold-start budget: import + startup should stay well under a second per worker
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "1.0"))
+timings = {"import_seconds": None, "startup_seconds": None}
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: the process is up and serving (no I/O)."""
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Readiness: one-time setup has finished and the primary database answers."""
+    body = {**timings, "setup_seconds": setup_state["seconds"]}
+    if setup_state["error"]:
+        return JSONResponse(status_code=503, content={"status": "setup failed", "detail": setup_state["error"], **body})
+    if not setup_state["done"]:
+        return JSONResponse(status_code=503, content={"status": "starting", **body})
+    try:
+        async def ping():
+            async with get_async_engine().connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        await asyncio.wait_for(ping(), timeout=2)
+    except Exception as err:
+        return JSONResponse(status_code=503, content={"status": "database unavailable", "detail": str(err), **body})
+    return {"status": "ready", **body}
+
+# Startup does no blocking DB work: table creation and seeding (superadmin, default plans)
+# run once in the background under an advisory lock, see app/setup.py
 @app.on_event("startup")
-def startup_setup():
-    # Create superadmin user if not exists, using env credentials
-    from sqlalchemy.orm import Session
-    db = Session(bind=engine)
-    super_email = os.getenv("SUPERADMIN_EMAIL")
-    super_pass = os.getenv("SUPERADMIN_PASSWORD")
-    if super_email and super_pass:
-        existing = db.query(models.User).filter(models.User.is_superadmin == True).first()
-        if not existing:
-            super_user = models.User(
-                email=super_email,
-                name="Superadmin",
-                password_hash=__import__('app.security').security.hash_password(super_pass),
-                is_superadmin=True,
-                is_tenant_admin=False
-            )
-            db.add(super_user)
-            db.commit()
-    # Optionally, create default plans Basic and Advanced if not exist
-    default_plans = [("Basic", 2), ("Advanced", 4)]
-    for name, max_feat in default_plans:
-        if not db.query(models.Plan).filter(models.Plan.name == name).first():
-            plan = models.Plan(name=name, max_features=max_feat)
-            db.add(plan)
-    db.commit()
-    db.close()
+async def startup_setup():
+    started = time.perf_counter()
+    start_background_setup()
+    if USAGE_BUFFER_ENABLED:
+        usage_buffer.start()
+    timings["startup_seconds"] = time.perf_counter() - started
+    total = timings["import_seconds"] + timings["startup_seconds"]
+    if total > STARTUP_BUDGET_SECONDS:
+        print(f"Warning: cold start took {total:.3f}s (budget {STARTUP_BUDGET_SECONDS}s)")
+
+# Drain buffered usage rows before the worker exits
+@app.on_event("shutdown")
+def shutdown_flush():
+    if USAGE_BUFFER_ENABLED:
+        usage_buffer.stop()
+    security.shutdown_hash_pool()
+
+timings["import_seconds"] = time.perf_counter() - app_package.IMPORT_STARTED
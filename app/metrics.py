@@ -0,0 +1,163 @@
+from contextvars import ContextVar
+from threading import Lock
+from sqlalchemy import event
+import logging, os, time
+
+# Per-request performance instrumentation: route latency histograms, SQL count/time and
+# connection pool wait, exported as Prometheus text (/metrics) and a Server-Timing header.
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))  # 0 disables the slow-request log
+SLOW_REQUEST_MAX_STATEMENTS = 50
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_log = logging.getLogger("app.slow_requests")
+
+
+class RequestStats:
+    __slots__ = ("sql_count", "sql_time", "pool_wait", "statements", "_sql_started")
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.pool_wait = 0.0
+        self.statements = []
+        self._sql_started = []
+
+
+_current = ContextVar("request_stats", default=None)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.count = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.pool_wait = 0.0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.routes = {}  # (method, route, status) -> RouteMetrics
+        self._lock = Lock()
+
+    def observe(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route, str(status))
+        with self._lock:
+            m = self.routes.get(key)
+            if m is None:
+                m = self.routes[key] = RouteMetrics()
+            m.count += 1
+            m.latency_sum += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    m.buckets[i] += 1
+            m.sql_count += stats.sql_count
+            m.sql_time += stats.sql_time
+            m.pool_wait += stats.pool_wait
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = [
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            items = sorted(self.routes.items())
+            for (method, route, status), m in items:
+                labels = f'method="{method}",route="{route}",status="{status}"'
+                for bound, n in zip(LATENCY_BUCKETS, m.buckets):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {m.count}')
+                lines.append(f"http_request_duration_seconds_sum{{{labels}}} {m.latency_sum}")
+                lines.append(f"http_request_duration_seconds_count{{{labels}}} {m.count}")
+            for name, attr, kind, help_text in (
+                ("http_request_sql_queries_total", "sql_count", "counter", "SQL statements executed by route."),
+                ("http_request_sql_seconds_total", "sql_time", "counter", "Time spent executing SQL by route."),
+                ("http_request_pool_wait_seconds_total", "pool_wait", "counter",
+                 "Time spent waiting for a pooled DB connection by route."),
+            ):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (method, route, status), m in items:
+                    lines.append(f'{name}{{method="{method}",route="{route}",status="{status}"}} {getattr(m, attr)}')
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None:
+        stats._sql_started.append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None and stats._sql_started:
+        elapsed = time.perf_counter() - stats._sql_started.pop()
+        stats.sql_count += 1
+        stats.sql_time += elapsed
+        if SLOW_REQUEST_MS and len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+            stats.statements.append((elapsed, statement))
+
+def _timed_pool_connect(connect):
+    def wrapper():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            stats = _current.get()
+            if stats is not None:
+                stats.pool_wait += time.perf_counter() - started
+    return wrapper
+
+def instrument_engine(engine):
+    """Attach SQL timing hooks and pool-wait timing to a (sync) Engine."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    engine.pool.connect = _timed_pool_connect(engine.pool.connect)
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records per-route metrics and adds a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths = None
+
+    def _route_for(self, scope) -> str:
+        if self._route_paths is None:
+            self._route_paths = {getattr(r, "endpoint", None): r.path for r in scope["app"].routes}
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                total_ms = (time.perf_counter() - started) * 1000
+                timing = (f'app;dur={total_ms:.2f}, db;dur={stats.sql_time * 1000:.2f};desc="{stats.sql_count} queries", '
+                          f"pool;dur={stats.pool_wait * 1000:.2f}")
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - started
+            route = self._route_for(scope)
+            registry.observe(scope["method"], route, status_code, elapsed, stats)
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                statements = "\n".join(f"  {t * 1000:.2f}ms {s}" for t, s in stats.statements)
+                slow_log.warning("Slow request %s %s %.1fms (%d queries, %.1fms SQL)\n%s",
+                                 scope["method"], route, elapsed * 1000, stats.sql_count,
+                                 stats.sql_time * 1000, statements)
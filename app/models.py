@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Date, Index, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -11,6 +11,7 @@ class Tenant(Base):
     name = Column(String(100), nullable=False)
     subdomain = Column(String(50), nullable=False, unique=True)
     plan_id = Column(Integer, ForeignKey("plans.id"), nullable=True)  # Tenant may select a plan later
+    shard = Column(String(50), nullable=False, default="default", server_default="default")  # see app/sharding.py
     created_at = Column(DateTime, default=datetime.utcnow)
 
     plan = relationship("Plan", back_populates="tenants")
@@ -23,6 +24,9 @@ class Plan(Base):
     name = Column(String(50), nullable=False, unique=True)
     max_features = Column(Integer, nullable=False)  # how many features (F1...Fn) are allowed
     # e.g., Basic = 2, Advanced = 4, corresponding to features F1..F4 allowed
+    # Token-bucket limits on feature usage (None = unlimited), see app/ratelimit.py
+    tenant_rate_per_minute = Column(Integer, nullable=True)   # all features of a tenant together
+    feature_rate_per_minute = Column(Integer, nullable=True)  # each feature of a tenant separately
 
     tenants = relationship("Tenant", back_populates="plan")
 
@@ -36,6 +40,8 @@ class User(Base):
     is_tenant_admin = Column(Boolean, default=False)
     tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Bumped whenever existing tokens must stop being honoured (password change, demotion, ...)
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     __table_args__ = (UniqueConstraint("tenant_id", "email", name="uq_user_email_per_tenant"),)
 
@@ -49,4 +55,70 @@ class Usage(Base):
     feature = Column(String(10), nullable=False)  # e.g., "F1", "F2", etc.
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+    # Per-tenant range scans (billing, exports) and time-range archival (app/archive.py)
+    __table_args__ = (
+        Index("ix_usages_tenant_timestamp", "tenant_id", "timestamp"),
+        Index("ix_usages_timestamp", "timestamp"),
+        Index("ix_usages_tenant_id_id", "tenant_id", "id"),  # incremental billing since a watermark id
+    )
+
     tenant = relationship("Tenant", back_populates="usages")
+
+class UsageDaily(Base):
+    """Per-day usage rollup, maintained alongside Usage and rebuildable from it (see app/rollup.py)."""
+    __tablename__ = "usage_daily"
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    feature = Column(String(10), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class PlatformStats(Base):
+    """The superadmin stats snapshot (a single row, id=1), written by a beat task (see app/stats.py)."""
+    __tablename__ = "platform_stats"
+    id = Column(Integer, primary_key=True)
+    generated_at = Column(DateTime, nullable=False)
+    body = Column(Text(2 ** 24), nullable=False)  # pre-serialized JSON; MEDIUMTEXT or larger on MySQL
+
+class BillingRun(Base):
+    """Progress of a scheduled billing cycle; `last_tenant_id` lets an interrupted run resume."""
+    __tablename__ = "billing_runs"
+    id = Column(Integer, primary_key=True)
+    period = Column(String(7), nullable=False, unique=True)  # "YYYY-MM"
+    status = Column(String(20), nullable=False, default="running")  # running / completed
+    last_tenant_id = Column(Integer, nullable=False, default=0)
+    tenants_processed = Column(Integer, nullable=False, default=0)
+    emails_queued = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+# Incremental billing (app/billing.py). These tables live on the tenant's shard, next to its usage,
+# so a billing record and the watermark move are committed in one transaction.
+class BillingWatermark(Base):
+    """Per-tenant billing position: usage rows with id <= last_usage_id have been billed."""
+    __tablename__ = "billing_watermarks"
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    last_usage_id = Column(Integer, nullable=False, default=0)
+    billed_until = Column(DateTime, nullable=True)  # when the watermark last moved
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class UsageFence(Base):
+    """A shard's max usage id at `taken_at`; billing stops at a settled fence (see app/billing.py)."""
+    __tablename__ = "usage_fences"
+    id = Column(Integer, primary_key=True)
+    max_usage_id = Column(Integer, nullable=False)
+    taken_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class BillingPeriod(Base):
+    """Record of one bill: the usage rows in (from_usage_id, to_usage_id]. Only `emailed_at` changes later."""
+    __tablename__ = "billing_periods"
+    id = Column(Integer, primary_key=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False, index=True)
+    from_usage_id = Column(Integer, nullable=False)  # exclusive
+    to_usage_id = Column(Integer, nullable=False)    # inclusive
+    period_start = Column(DateTime, nullable=True)   # previous billed_until (None for the first bill)
+    period_end = Column(DateTime, nullable=False)
+    usage = Column(Text, nullable=False)             # JSON {feature: count}
+    total_usage = Column(Integer, nullable=False)
+    run = Column(String(7), nullable=True)           # billing cycle that made it ("YYYY-MM"); None if on demand
+    emailed_at = Column(DateTime, nullable=True)     # statement email queued (the outbox, see app/tasks/billing.py)
+    created_at = Column(DateTime, default=datetime.utcnow)
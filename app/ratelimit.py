@@ -0,0 +1,128 @@
+from threading import Lock
+import math, os, time
+
+# Token-bucket limits for feature usage, configured per plan (Plan.tenant_rate_per_minute and
+# Plan.feature_rate_per_minute). Each bucket holds one minute's allowance and refills
+# continuously. By default buckets live in process memory; set RATE_LIMIT_REDIS_URL to share
+# them across workers (any redis.asyncio-compatible client works, e.g. fakeredis in tests).
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class OverCapacity(Exception):
+    """A single request charges more than a bucket can ever hold, so retrying it can't succeed."""
+
+
+class LocalLimiter:
+    """In-process token buckets. All buckets in one call are checked and consumed atomically."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> [tokens, updated_at]
+        self._lock = Lock()
+
+    async def acquire(self, buckets: list) -> float:
+        """Take `cost` tokens from each (key, rate_per_minute, cost) bucket; returns 0 or seconds to wait."""
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            retry_after = 0.0
+            for key, rate, cost in buckets:
+                state = self._buckets.get(key)
+                if state is None:
+                    if len(self._buckets) >= self.max_keys:
+                        self._buckets.clear()  # crude bound; buckets simply start full again
+                    state = self._buckets[key] = [float(rate), now]
+                tokens = min(float(rate), state[0] + (now - state[1]) * rate / 60.0)
+                state[0], state[1] = tokens, now
+                if tokens < cost:
+                    retry_after = max(retry_after, (cost - tokens) * 60.0 / rate)
+                states.append((state, cost))
+            if retry_after:
+                return retry_after
+            for state, cost in states:
+                state[0] -= cost
+            return 0.0
+
+
+# KEYS = bucket keys, ARGV = [now, rate_1, cost_1, rate_2, cost_2, ...]; returns retry-after in ms (0 = allowed)
+_TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local retry = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local cost = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 't', 'u')
+    local t = tonumber(state[1]) or rate
+    local u = tonumber(state[2]) or now
+    t = math.min(rate, t + (now - u) * rate / 60000)
+    tokens[i] = t
+    if t < cost then
+        retry = math.max(retry, math.ceil((cost - t) * 60000 / rate))
+    end
+end
+for i, key in ipairs(KEYS) do
+    local t = tokens[i]
+    if retry == 0 then t = t - tonumber(ARGV[2 * i + 1]) end
+    redis.call('HSET', key, 't', t, 'u', now)
+    redis.call('PEXPIRE', key, 120000)
+end
+return retry
+"""
+
+
+class RedisLimiter:
+    """Token buckets shared through Redis; one Lua script call per request keeps them atomic."""
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    async def acquire(self, buckets: list) -> float:
+        keys = [self.prefix + key for key, _, _ in buckets]
+        args = [int(time.time() * 1000)]
+        for _, rate, cost in buckets:
+            args += [rate, cost]
+        retry_ms = await self.client.eval(_TOKEN_BUCKET_LUA, len(keys), *keys, *args)
+        return int(retry_ms) / 1000.0
+
+
+def _default_limiter():
+    if RATE_LIMIT_REDIS_URL:
+        import redis.asyncio as redis
+        return RedisLimiter(redis.from_url(RATE_LIMIT_REDIS_URL))
+    return LocalLimiter()
+
+
+limiter = _default_limiter()
+
+
+def set_limiter(new_limiter):
+    """Swap the limiter backend (e.g. RedisLimiter(fakeredis.aioredis.FakeRedis()) in tests)."""
+    global limiter
+    limiter = new_limiter
+
+
+async def check_feature_rate(plan: dict, tenant_id: int, feature_counts: dict):
+    """Charge {feature: uses} against the plan's buckets.
+
+    Returns seconds until the request may be retried, or None if it is allowed. Raises
+    OverCapacity (without charging anything) if a bucket could never cover the charge.
+    """
+    buckets = []
+    if plan.get("tenant_rate_per_minute"):
+        rate, total = plan["tenant_rate_per_minute"], sum(feature_counts.values())
+        if total > rate:
+            raise OverCapacity(f"{total} uses exceed the plan's limit of {rate} per minute")
+        buckets.append((f"t:{tenant_id}", rate, total))
+    if plan.get("feature_rate_per_minute"):
+        rate = plan["feature_rate_per_minute"]
+        for feature, count in feature_counts.items():
+            if count > rate:
+                raise OverCapacity(f"{count} uses of {feature} exceed the plan's limit of {rate} per minute")
+            buckets.append((f"t:{tenant_id}:{feature}", rate, count))
+    if not buckets:
+        return None
+    retry_after = await limiter.acquire(buckets)
+    return math.ceil(retry_after) if retry_after else None
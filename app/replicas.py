@@ -0,0 +1,179 @@
+"""Read-replica routing.
+
+REPLICA_URLS is a JSON object of shard name -> replica URL (or list of URLs), e.g.
+{"default": ["mysql+pymysql://ro@replica1/multitenant"]}. Each replica gets its own async
+connection pool, created on first use.
+
+Safe requests (GET/HEAD) read from a replica of the shard they touch; everything else uses
+the primary. A client that has just written is pinned to the primary for
+REPLICA_STICKY_SECONDS so it reads its own writes: the response to a write carries the time
+of the write (a `last_write` cookie and an X-Last-Write header to echo back), so whichever
+worker serves the next request knows. A replica whose lag exceeds REPLICA_MAX_LAG seconds
+(or that can't be reached) is skipped until its next check.
+"""
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from threading import Lock
+import asyncio, itertools, json, math, os, time
+
+from app.sharding import DEFAULT_SHARD, async_url, get_shard
+
+REPLICA_URLS = json.loads(os.getenv("REPLICA_URLS", "{}"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+STICKY_COOKIE = "last_write"
+STICKY_HEADER = "x-last-write"
+
+
+class Replica:
+    def __init__(self, shard: str, url: str):
+        self.shard = shard
+        self.async_engine = create_async_engine(async_url(url), pool_pre_ping=True)
+        self.AsyncSessionLocal = sessionmaker(self.async_engine, class_=AsyncSession, autoflush=False,
+                                              expire_on_commit=False, info={"shard": shard, "replica": True})
+        self.lag = None  # seconds behind the primary; None = unknown / unreachable
+        self.checked_at = None
+        self._checking = False
+
+    async def _measure_lag(self) -> float:
+        async with self.async_engine.connect() as conn:
+            dialect = self.async_engine.dialect.name
+            if dialect == "mysql":
+                try:
+                    row = (await conn.execute(text("SHOW REPLICA STATUS"))).mappings().first()
+                except Exception:
+                    # MySQL < 8.0.22
+                    row = (await conn.execute(text("SHOW SLAVE STATUS"))).mappings().first()
+                if row is None:
+                    return 0.0  # not a replica (e.g. a read-only alias of the primary)
+                lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+                return None if lag is None else float(lag)
+            if dialect == "postgresql":
+                lag = (await conn.execute(text(
+                    "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"))).scalar()
+                return float(lag)
+            await conn.execute(text("SELECT 1"))
+            return 0.0
+
+    async def usable(self) -> bool:
+        """True if the replica is within REPLICA_MAX_LAG; re-measured at most every check interval."""
+        now = time.monotonic()
+        stale = self.checked_at is None or now - self.checked_at >= REPLICA_LAG_CHECK_INTERVAL
+        if stale and not self._checking:
+            self._checking = True
+            try:
+                self.lag = await asyncio.wait_for(self._measure_lag(), timeout=1)
+            except Exception:
+                self.lag = None
+            finally:
+                self.checked_at = time.monotonic()
+                self._checking = False
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG
+
+    def status(self) -> dict:
+        return {"shard": self.shard, "lag": self.lag, "usable": self.lag is not None and self.lag <= REPLICA_MAX_LAG}
+
+
+_replicas = {}
+_rotation = {}
+_replicas_lock = Lock()
+
+
+def get_replicas(shard: str) -> list:
+    """Replicas configured for a shard (engines are created on first use)."""
+    replicas = _replicas.get(shard)
+    if replicas is not None:
+        return replicas
+    with _replicas_lock:
+        if shard not in _replicas:
+            urls = REPLICA_URLS.get(shard) or []
+            if isinstance(urls, str):
+                urls = [urls]
+            from app.metrics import instrument_engine
+            replicas = [Replica(shard, url) for url in urls]
+            for replica in replicas:
+                instrument_engine(replica.async_engine.sync_engine)
+            _rotation[shard] = itertools.cycle(range(len(replicas)))
+            _replicas[shard] = replicas
+        return _replicas[shard]
+
+
+async def read_sessionmaker(shard: str):
+    """Session factory for reads on a shard: the next usable replica in rotation, else the primary."""
+    replicas = get_replicas(shard)
+    for _ in range(len(replicas)):
+        replica = replicas[next(_rotation[shard])]
+        if await replica.usable():
+            return replica.AsyncSessionLocal
+    return get_shard(shard).AsyncSessionLocal
+
+
+def mark_write(request):
+    if REPLICA_URLS:
+        request.state.last_write = time.time()
+
+
+def wrote_recently(request) -> bool:
+    """Whether the client's last write (X-Last-Write header or cookie) is within REPLICA_STICKY_SECONDS."""
+    value = request.headers.get(STICKY_HEADER) or request.cookies.get(STICKY_COOKIE)
+    if not value:
+        return False
+    try:
+        age = time.time() - float(value)
+    except ValueError:
+        return False
+    # One second of slack for clock skew between hosts; other future times are ignored
+    return -1 <= age < REPLICA_STICKY_SECONDS
+
+
+class StickyWritesMiddleware:
+    """ASGI middleware that hands a client that wrote the time of its write (cookie + header)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        state = scope.setdefault("state", {})
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and "last_write" in state:
+                value = f"{state['last_write']:.3f}"
+                cookie = f"{STICKY_COOKIE}={value}; Max-Age={math.ceil(REPLICA_STICKY_SECONDS)}; Path=/; HttpOnly; SameSite=Lax"
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"set-cookie", cookie.encode()), (STICKY_HEADER.encode(), value.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+async def routed_sessionmaker(request, shard: str, read_only: bool = False):
+    """Session factory for a request on a shard.
+
+    Safe methods (or read-only dependencies) read from a replica unless the client wrote
+    recently; any other request counts as a write and pins the client to the primary.
+    """
+    if read_only or request.method in SAFE_METHODS:
+        if not wrote_recently(request):
+            return await read_sessionmaker(shard)
+    else:
+        mark_write(request)
+    return get_shard(shard).AsyncSessionLocal
+
+
+def from_replica(db) -> bool:
+    """Whether an async session is bound to a replica (lookups that miss may retry on the primary)."""
+    return db.sync_session.info.get("replica", False)
+
+
+def primary_session(db):
+    """A primary session on the same shard as `db`."""
+    return get_shard(db.sync_session.info.get("shard", DEFAULT_SHARD)).AsyncSessionLocal()
+
+
+def replica_status() -> list:
+    return [r.status() for replicas in _replicas.values() for r in replicas]
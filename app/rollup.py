@@ -0,0 +1,80 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app.models import Usage, UsageDaily
+from app.archive import archived_daily_counts
+from app.sharding import DEFAULT_SHARD, get_shard
+from collections import Counter
+from datetime import datetime
+
+# Incremental maintenance of the usage_daily rollup. Callers pass the rows they are about to
+# insert into `usages` and commit both in the same transaction.
+
+def rollup_counts(rows) -> Counter:
+    """Group usage rows (dicts or Usage objects) into {(tenant_id, feature, day): count}."""
+    counts = Counter()
+    for row in rows:
+        if isinstance(row, dict):
+            tenant_id, feature, ts = row["tenant_id"], row["feature"], row.get("timestamp")
+        else:
+            tenant_id, feature, ts = row.tenant_id, row.feature, row.timestamp
+        counts[(tenant_id, feature, (ts or datetime.utcnow()).date())] += 1
+    return counts
+
+def apply_rollup(db: Session, counts: Counter):
+    """Add counts to usage_daily with a dialect-native upsert (no commit)."""
+    if not counts:
+        return
+    # Rows in primary-key order, so concurrent upserts lock them in the same order and can't deadlock
+    values = [{"tenant_id": t, "feature": f, "day": d, "count": n} for (t, f, d), n in sorted(counts.items())]
+    table = UsageDaily.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        stmt = stmt.on_duplicate_key_update(count=table.c.count + stmt.inserted["count"])
+        db.execute(stmt, values)
+    elif dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.tenant_id, table.c.feature, table.c.day],
+            set_={"count": table.c.count + stmt.excluded["count"]},
+        )
+        db.execute(stmt, values)
+    else:
+        for v in values:
+            updated = db.query(UsageDaily).filter(
+                UsageDaily.tenant_id == v["tenant_id"], UsageDaily.feature == v["feature"], UsageDaily.day == v["day"]
+            ).update({UsageDaily.count: UsageDaily.count + v["count"]}, synchronize_session=False)
+            if not updated:
+                db.add(UsageDaily(**v))
+
+def rebuild_rollup(db: Session, tenant_id: int = None) -> int:
+    """Recompute usage_daily from the raw usages table plus archived segments. Returns rows written."""
+    delete_q = db.query(UsageDaily)
+    source_q = db.query(Usage.tenant_id, Usage.feature, func.date(Usage.timestamp), func.count(Usage.id))
+    if tenant_id is not None:
+        delete_q = delete_q.filter(UsageDaily.tenant_id == tenant_id)
+        source_q = source_q.filter(Usage.tenant_id == tenant_id)
+    delete_q.delete(synchronize_session=False)
+    source_q = source_q.group_by(Usage.tenant_id, Usage.feature, func.date(Usage.timestamp))
+    stmt = UsageDaily.__table__.insert().from_select(
+        ["tenant_id", "feature", "day", "count"], source_q.statement
+    )
+    result = db.execute(stmt)
+    # Months already moved out of the hot table only exist in archive segments
+    archived = archived_daily_counts(tenant_id, shard=db.info.get("shard", DEFAULT_SHARD))
+    apply_rollup(db, archived)
+    db.commit()
+    return result.rowcount + len(archived)
+
+def rebuild_shard_rollup(shard: str, tenant_id: int = None) -> int:
+    """rebuild_rollup on its own session of one shard; blocking, so async callers run it in a thread."""
+    db = get_shard(shard).SessionLocal()
+    try:
+        return rebuild_rollup(db, tenant_id)
+    finally:
+        db.close()
@@ -1,87 +1,222 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 from app import schemas, security
-from app.dependencies import get_db, get_current_user
+from app.dependencies import get_async_db, get_read_db, get_current_user, get_plan_catalog, tenant_shard
+from app.replicas import routed_sessionmaker
+from app.export import parse_cursor, usage_export_response
+from app.streaming import keyset_page, ndjson_response, rows_to_dicts
+from fastapi.responses import ORJSONResponse, Response
+from app.sharding import DEFAULT_SHARD, NEW_TENANT_SHARD, SHARD_URLS, copy_tenant_row, get_shard, shard_names
+from app.catalog import PlanCatalog, plan_catalog, plan_list_response
+from app.cache import tenant_cache
+from app.ingest import usage_buffer
+from app.stats import stats_snapshot
+from app.rollup import rebuild_shard_rollup
 from app.models import User, Tenant, Plan
-from typing import List
+from datetime import datetime
+from typing import List, Optional
+import asyncio
 
 router = APIRouter(prefix="/superadmin")
 
 # Dependency specifically requiring superadmin privileges
-def superadmin_required(current_user: User = Depends(get_current_user)):
+async def superadmin_required(current_user: User = Depends(get_current_user)):
     if not current_user.is_superadmin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Superadmin access required")
     return current_user
 
 @router.post("/login", response_model=schemas.TokenResponse)
-def superadmin_login(credentials: schemas.LoginRequest, db: Session = Depends(get_db)):
+async def superadmin_login(credentials: schemas.LoginRequest, db: AsyncSession = Depends(get_async_db)):
     """Superadmin login to get JWT token."""
-    user = db.query(User).filter(User.email == credentials.email, User.is_superadmin == True).first()
-    if not user or not security.verify_password(credentials.password, user.password_hash):
+    result = await db.execute(select(User).where(User.email == credentials.email, User.is_superadmin == True))
+    user = result.scalars().first()
+    # bcrypt runs in the hashing pool; stored hashes below the current work factor are upgraded in place
+    verified, new_hash = False, None
+    if user:
+        verified, new_hash = await security.verify_and_update_async(credentials.password, user.password_hash)
+    if not verified:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     # Create JWT token with role
     token_data = {"user_id": user.id, "role": "superadmin"}
+    if security.AUTH_CLAIMS_MODE:
+        token_data = security.user_claims(user)
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
     access_token = security.create_access_token(token_data)
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/plans", response_model=schemas.PlanOut)
-def create_plan(plan_in: schemas.PlanCreate, 
-                db: Session = Depends(get_db), 
-                current_user: User = Depends(superadmin_required)):
+async def create_plan(plan_in: schemas.PlanCreate, 
+                      db: AsyncSession = Depends(get_async_db), 
+                      current_user: User = Depends(superadmin_required)):
     """Create a new subscription plan (superadmin only)."""
     # Ensure plan name is unique
-    existing = db.query(Plan).filter(Plan.name == plan_in.name).first()
+    existing = (await db.execute(select(Plan).where(Plan.name == plan_in.name))).scalars().first()
     if existing:
         raise HTTPException(status_code=400, detail="Plan name already exists")
-    plan = Plan(name=plan_in.name, max_features=plan_in.max_features)
+    plan = Plan(name=plan_in.name, max_features=plan_in.max_features,
+                tenant_rate_per_minute=plan_in.tenant_rate_per_minute,
+                feature_rate_per_minute=plan_in.feature_rate_per_minute)
     db.add(plan)
-    db.commit()
-    db.refresh(plan)
+    await db.commit()
+    await db.refresh(plan)
+    plan_catalog.invalidate()
     return plan
 
 @router.get("/plans", response_model=List[schemas.PlanOut])
-def list_plans(db: Session = Depends(get_db), current_user: User = Depends(superadmin_required)):
-    """List all plans."""
-    plans = db.query(Plan).all()
-    return plans
+async def list_plans(request: Request,
+                     catalog: PlanCatalog = Depends(get_plan_catalog),
+                     current_user: User = Depends(superadmin_required)):
+    """List all plans (served from the plan catalog, supports If-None-Match)."""
+    return plan_list_response(request, catalog)
 
 @router.post("/tenants", response_model=schemas.TenantOut)
-def create_tenant(tenant_in: schemas.TenantCreate, 
-                  db: Session = Depends(get_db),
-                  current_user: User = Depends(superadmin_required)):
+async def create_tenant(tenant_in: schemas.TenantCreate, 
+                        db: AsyncSession = Depends(get_async_db),
+                        current_user: User = Depends(superadmin_required)):
     """Create a new tenant with an initial admin user."""
     # Check subdomain uniqueness
-    if db.query(Tenant).filter(Tenant.subdomain == tenant_in.subdomain).first():
+    if (await db.execute(select(Tenant.id).where(Tenant.subdomain == tenant_in.subdomain))).first():
         raise HTTPException(status_code=400, detail="Subdomain already in use")
     # Check if admin email is used by any user (optional: ensure globally unique email)
-    if db.query(User).filter(User.email == tenant_in.admin_email, User.tenant_id == None).first():
+    if (await db.execute(select(User.id).where(User.email == tenant_in.admin_email, User.tenant_id == None))).first():
         # if the email is used by superadmin or another tenant? 
         # (We only ensure within same tenant via unique constraint, but superadmin email or reuse across tenants might be allowed in some cases)
         raise HTTPException(status_code=400, detail="Email already taken by another account")
-    # Create tenant
-    tenant = Tenant(name=tenant_in.name, subdomain=tenant_in.subdomain)
+    shard = tenant_in.shard or NEW_TENANT_SHARD
+    if shard != DEFAULT_SHARD and shard not in SHARD_URLS:
+        raise HTTPException(status_code=400, detail=f"Unknown shard '{shard}'")
+    password_hash = await security.hash_password_async(tenant_in.admin_password)
+    # Create tenant in the directory
+    tenant = Tenant(name=tenant_in.name, subdomain=tenant_in.subdomain, shard=shard)
     db.add(tenant)
-    db.flush()  # flush to get tenant.id for user relation
+    await db.flush()  # flush to get tenant.id for user relation
     # Create initial admin user for tenant
     admin_user = User(email=tenant_in.admin_email,
                       name=None,
-                      password_hash=security.hash_password(tenant_in.admin_password),
+                      password_hash=password_hash,
                       is_superadmin=False,
                       is_tenant_admin=True,
-                      tenant=tenant)
-    db.add(admin_user)
-    db.commit()
-    db.refresh(tenant)
+                      tenant_id=tenant.id)
+    if shard == DEFAULT_SHARD:
+        db.add(admin_user)
+    else:
+        # Tenant data lives on its shard; write it there before committing the directory row
+        async with get_shard(shard).AsyncSessionLocal() as shard_db:
+            await shard_db.run_sync(copy_tenant_row, tenant)
+            shard_db.add(admin_user)
+            await shard_db.commit()
+    await db.commit()
+    await db.refresh(tenant)
+    # Drop any cached "not found" entry for this subdomain
+    tenant_cache.invalidate(tenant.subdomain)
     return tenant
 
 @router.get("/tenants", response_model=List[schemas.TenantOut])
-def list_tenants(db: Session = Depends(get_db), current_user: User = Depends(superadmin_required)):
-    """List all tenants."""
-    tenants = db.query(Tenant).all()
-    return tenants
+async def list_tenants(request: Request,
+                       limit: Optional[int] = Query(None, ge=1, le=1000),
+                       after: Optional[int] = None,
+                       format: str = Query("json", pattern="^(json|ndjson)$"),
+                       db: AsyncSession = Depends(get_read_db),
+                       current_user: User = Depends(superadmin_required)):
+    """List all tenants.
+
+    Pass `limit` (and `after` = the X-Next-Cursor of the previous page) for keyset pagination,
+    or `format=ndjson` to stream every tenant without buffering the whole list.
+    """
+    # Fast path: select exactly the response columns and serialize them with orjson
+    stmt = select(*schemas.response_columns(Tenant, schemas.TenantOut))
+    if format == "ndjson":
+        return ndjson_response(await routed_sessionmaker(request, DEFAULT_SHARD, read_only=True),
+                               keyset_page(stmt, Tenant.id, after=after))
+    stmt = keyset_page(stmt, Tenant.id, limit, after)
+    tenants = rows_to_dicts(await db.execute(stmt))
+    headers = {}
+    if limit is not None and len(tenants) == limit:
+        headers["X-Next-Cursor"] = str(tenants[-1]["id"])
+    return ORJSONResponse(tenants, headers=headers)
 
 @router.get("/tenants/{tenant_id}/users", response_model=List[schemas.UserOut])
-def list_tenant_users(tenant_id: int, db: Session = Depends(get_db), current_user: User = Depends(superadmin_required)):
-    """View all users under a particular tenant."""
-    users = db.query(User).filter(User.tenant_id == tenant_id).all()
-    return users
+async def list_tenant_users(request: Request,
+                            tenant_id: int,
+                            limit: Optional[int] = Query(None, ge=1, le=1000),
+                            after: Optional[int] = None,
+                            format: str = Query("json", pattern="^(json|ndjson)$"),
+                            db: AsyncSession = Depends(get_read_db),
+                            current_user: User = Depends(superadmin_required)):
+    """View all users under a particular tenant (same `limit`/`after`/`format` options as tenant listing)."""
+    shard = await tenant_shard(db, tenant_id)
+    if shard is None:
+        return []
+    stmt = select(*schemas.response_columns(User, schemas.UserOut)).where(User.tenant_id == tenant_id)
+    session_factory = await routed_sessionmaker(request, shard, read_only=True)
+    if format == "ndjson":
+        return ndjson_response(session_factory, keyset_page(stmt, User.id, after=after))
+    stmt = keyset_page(stmt, User.id, limit, after)
+    async with session_factory() as shard_db:
+        users = rows_to_dicts(await shard_db.execute(stmt))
+    headers = {}
+    if limit is not None and len(users) == limit:
+        headers["X-Next-Cursor"] = str(users[-1]["id"])
+    return ORJSONResponse(users, headers=headers)
+
+@router.get("/tenants/{tenant_id}/usage/export")
+async def export_tenant_usage(request: Request,
+                              tenant_id: int,
+                              start: Optional[datetime] = None,
+                              end: Optional[datetime] = None,
+                              format: str = Query("csv", pattern="^(csv|ndjson)$"),
+                              gzip: bool = False,
+                              after: Optional[str] = None,
+                              db: AsyncSession = Depends(get_read_db),
+                              current_user: User = Depends(superadmin_required)):
+    """Download a tenant's raw usage events (same options as /tenant/usage/export)."""
+    shard = await tenant_shard(db, tenant_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="Tenant not found")
+    return usage_export_response(await routed_sessionmaker(request, shard, read_only=True), tenant_id, shard,
+                                 f"usage-tenant-{tenant_id}", format, gzip, start, end, parse_cursor(after))
+
+@router.get("/stats")
+async def platform_stats(db: AsyncSession = Depends(get_read_db), current_user: User = Depends(superadmin_required)):
+    """Tenants per plan, users per tenant and usage per feature over recent windows.
+
+    Served from the snapshot a beat task stores in the directory (see app/stats.py);
+    `generated_at` and the Age header tell how fresh it is.
+    """
+    snapshot = await stats_snapshot.get(db)
+    if snapshot is None:
+        # Nothing collected yet (fresh install, or beat not running): ask a worker for one
+        if stats_snapshot.should_request_refresh():
+            from app.tasks.stats import refresh_platform_stats
+            await run_in_threadpool(refresh_platform_stats.delay)
+        raise HTTPException(status_code=503, detail="Platform stats are being collected, please retry",
+                            headers={"Retry-After": "5"})
+    body, generated_at = snapshot
+    age = max(0, int((datetime.utcnow() - generated_at).total_seconds()))
+    return Response(body, media_type="application/json", headers={"Age": str(age)})
+
+@router.get("/ingest")
+async def ingest_stats(current_user: User = Depends(superadmin_required)):
+    """Usage write-behind buffer statistics (depth, flush latency, rows per flush)."""
+    return usage_buffer.stats()
+
+@router.post("/usage/rebuild", response_model=schemas.Message)
+async def rebuild_usage_rollup(tenant_id: Optional[int] = None,
+                               db: AsyncSession = Depends(get_async_db),
+                               current_user: User = Depends(superadmin_required)):
+    """Rebuild the daily usage rollup from raw usage rows (one tenant, or all when tenant_id is omitted)."""
+    shards = shard_names()
+    if tenant_id is not None:
+        shard = await tenant_shard(db, tenant_id)
+        if shard is None:
+            raise HTTPException(status_code=404, detail="Tenant not found")
+        shards = [shard]
+    # Each shard rebuilds its own rollup, concurrently; reading archived segments is CPU/disk
+    # work, so it runs in worker threads rather than on the event loop
+    results = await asyncio.gather(*(run_in_threadpool(rebuild_shard_rollup, shard, tenant_id) for shard in shards))
+    rows = sum(results)
+    return {"detail": f"Usage rollup rebuilt ({rows} rows)"}
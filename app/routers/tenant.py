@@ -1,20 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 from app import schemas, security
-from app.dependencies import get_db, get_current_user, get_current_tenant
+from app.dependencies import get_async_db, get_tenant_db, get_current_user, get_current_tenant, get_plan_catalog
+from app.catalog import PlanCatalog, plan_list_response
+from app.cache import tenant_cache, analytics_cache, billing_triggers, MISSING
+from app.ingest import usage_buffer, utc_naive, USAGE_BUFFER_ENABLED
+from app.rollup import rollup_counts, apply_rollup
+from app.ratelimit import check_feature_rate, OverCapacity
+from app.sharding import get_shard
+from app.replicas import routed_sessionmaker
+from app.export import parse_cursor, usage_export_response
+from app.user_import import parse_rows, validate_rows, import_users, USER_IMPORT_MAX_ROWS
+from fastapi.responses import StreamingResponse
+import queue
 from app.models import User, Tenant, Plan, Usage
-from app.tasks.billing import send_billing_email  # Celery task
-from datetime import datetime
+from datetime import datetime, timedelta
 from fastapi import Request
-from typing import List
+from typing import List, Optional
 
 
 
 router = APIRouter(prefix="/tenant")
 
+# Client timestamps in a usage batch may not be further in the future / past than this
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+MAX_BACKDATE = timedelta(days=1)
+
 
 # Dependency that ensures we have a tenant context and a current user from that tenant
-def tenant_user_required(
+async def tenant_user_required(
     current_user: User = Depends(get_current_user),
     tenant: Tenant = Depends(get_current_tenant)
 ):
@@ -26,32 +42,44 @@ def tenant_user_required(
     return {"user": current_user, "tenant": tenant}
 
 @router.post("/login", response_model=schemas.TokenResponse)
-def tenant_login(credentials: schemas.LoginRequest, 
-                db: Session = Depends(get_db), 
-                tenant: Tenant = Depends(get_current_tenant)):
+async def tenant_login(credentials: schemas.LoginRequest, 
+                       db: AsyncSession = Depends(get_tenant_db), 
+                       tenant: Tenant = Depends(get_current_tenant)):
     """Tenant user login (at subdomain). If first time, prompt plan selection after login."""
     if tenant is None:
         
         raise HTTPException(status_code=400, detail="Tenant login should be done on tenant subdomain")
-    user = db.query(User).filter(User.email == credentials.email, User.tenant_id == tenant.id).first()
-    if not user or not security.verify_password(credentials.password, user.password_hash):
+    result = await db.execute(select(User).where(User.email == credentials.email, User.tenant_id == tenant.id))
+    user = result.scalars().first()
+    # bcrypt runs in the hashing pool; stored hashes below the current work factor are upgraded in place
+    verified, new_hash = False, None
+    if user:
+        verified, new_hash = await security.verify_and_update_async(credentials.password, user.password_hash)
+    if not verified:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     # Create token with user_id and tenant_id
     token_data = {"user_id": user.id, "tenant_id": tenant.id}
+    if security.AUTH_CLAIMS_MODE:
+        token_data = security.user_claims(user)
+    # User ids are only unique within a shard: tie the token to the shard it was issued on
+    token_data["shard"] = tenant.shard
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
     access_token = security.create_access_token(token_data)
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.get("/plans", response_model=List[schemas.PlanOut])
-def get_available_plans(db: Session = Depends(get_db),
-                        context: dict = Depends(tenant_user_required)):
+async def get_available_plans(request: Request,
+                              catalog: PlanCatalog = Depends(get_plan_catalog),
+                              context: dict = Depends(tenant_user_required)):
     """Get available plans (for plan selection, accessible to tenant users)."""
-    plans = db.query(Plan).all()
-    return plans
+    return plan_list_response(request, catalog)
 
 @router.post("/plan/select", response_model=schemas.Message)
 async def select_plan(
     request: Request,  
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     context: dict = Depends(tenant_user_required)
     ):
     current_user = context["user"]
@@ -69,49 +97,80 @@ async def select_plan(
     if not plan_id:
         raise HTTPException(status_code=400, detail="plan_id is required")
 
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+    plan = (await db.execute(select(Plan).where(Plan.id == plan_id))).scalars().first()
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
 
-    tenant.plan_id = plan.id
-    db.commit()
+    # tenant is a cached snapshot, so update the row directly and invalidate the cache entry
+    # (this worker's only: others see the new plan within TENANT_CACHE_TTL, see app/cache.py)
+    await db.execute(update(Tenant).where(Tenant.id == tenant.id).values(plan_id=plan.id))
+    await db.commit()
+    tenant_cache.invalidate(tenant.subdomain)
     return {"detail": f"Plan '{plan.name}' has been assigned to tenant {tenant.name}."}
 
 
 @router.post("/users", response_model=schemas.UserOut)
-def create_user(user_in: schemas.UserCreate, 
-                db: Session = Depends(get_db),
-                context: dict = Depends(tenant_user_required)):
+async def create_user(user_in: schemas.UserCreate, 
+                      db: AsyncSession = Depends(get_tenant_db),
+                      context: dict = Depends(tenant_user_required)):
     """Create a new user under this tenant (tenant admin only)."""
     current_user = context["user"]
     tenant = context["tenant"]
     if not current_user.is_tenant_admin:
         raise HTTPException(status_code=403, detail="Only tenant admin can create users")
     # Check email not already used in this tenant
-    if db.query(User).filter(User.tenant_id == tenant.id, User.email == user_in.email).first():
+    if (await db.execute(select(User.id).where(User.tenant_id == tenant.id, User.email == user_in.email))).first():
         raise HTTPException(status_code=400, detail="Email already in use in this tenant")
     user = User(email=user_in.email,
                 name=user_in.name,
-                password_hash=security.hash_password(user_in.password),
+                password_hash=await security.hash_password_async(user_in.password),
                 is_superadmin=False,
                 is_tenant_admin=False,
                 tenant_id=tenant.id)
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return user
 
+@router.post("/users/import")
+async def import_users_bulk(request: Request, context: dict = Depends(tenant_user_required)):
+    """Bulk-create users from a CSV (email,name,password) or JSON array body (tenant admin only).
+
+    Streams NDJSON: one result line per row as each chunk is committed, then a summary line.
+    Rows that could not be hashed while the server was busy come back with status "retry".
+    """
+    current_user = context["user"]
+    tenant = context["tenant"]
+    if not current_user.is_tenant_admin:
+        raise HTTPException(status_code=403, detail="Only tenant admin can create users")
+    try:
+        rows = parse_rows(await request.body(), request.headers.get("content-type"))
+    except (ValueError, UnicodeDecodeError) as err:
+        raise HTTPException(status_code=400, detail=f"Could not parse import: {err}")
+    if len(rows) > USER_IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {USER_IMPORT_MAX_ROWS} users per import")
+    valid, rejected = validate_rows(rows)
+    return StreamingResponse(import_users(get_shard(tenant.shard).AsyncSessionLocal, tenant.id, valid, rejected),
+                             media_type="application/x-ndjson")
+
 @router.post("/features/use", response_model=schemas.Message)
-def use_feature(request: schemas.FeatureUseRequest,
-                db: Session = Depends(get_db),
-                context: dict = Depends(tenant_user_required)):
+async def use_feature(request: schemas.FeatureUseRequest,
+                      db: AsyncSession = Depends(get_tenant_db),
+                      directory: AsyncSession = Depends(get_async_db),
+                      catalog: PlanCatalog = Depends(get_plan_catalog),
+                      context: dict = Depends(tenant_user_required)):
     """Trigger usage of a feature (F1-F4) by the current user."""
     current_user = context["user"]
     tenant = context["tenant"]
     # Ensure tenant has a plan
     if tenant.plan_id is None:
         raise HTTPException(status_code=402, detail="No plan selected. Please select a plan to use features.")
-    plan = db.query(Plan).filter(Plan.id == tenant.plan_id).first()
+    plan = catalog.get(tenant.plan_id)
+    if not plan:
+        # Plan may have been created by another worker since the catalog was loaded.
+        # Plans live in the directory; the tenant's shard has an empty plans table.
+        await directory.run_sync(catalog.load)
+        plan = catalog.get(tenant.plan_id)
     if not plan:
         raise HTTPException(status_code=500, detail="Plan assigned to tenant not found")
     feature_code = request.feature  # like "F3"
@@ -123,33 +182,167 @@ def use_feature(request: schemas.FeatureUseRequest,
     if feature_index is None:
         raise HTTPException(status_code=400, detail="Invalid feature code")
     # Check plan allowance
-    if feature_index > plan.max_features:
+    if feature_index > plan["max_features"]:
         raise HTTPException(status_code=403, detail=f"Feature {feature_code} is not available for your plan")
+    # Enforce plan rate limits in memory, before any usage is written
+    retry_after = await check_feature_rate(plan, tenant.id, {feature_code: 1})
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded for your plan",
+                            headers={"Retry-After": str(retry_after)})
     # Record usage
-    usage = Usage(tenant_id=tenant.id, user_id=current_user.id, feature=feature_code)
-    db.add(usage)
-    db.commit()
+    if USAGE_BUFFER_ENABLED:
+        try:
+            usage_buffer.add(tenant.id, current_user.id, feature_code, shard=tenant.shard, block=False)
+        except queue.Full:
+            # Buffer is full: wait for room off the event loop, then give up with 503
+            try:
+                await run_in_threadpool(usage_buffer.add, tenant.id, current_user.id, feature_code, shard=tenant.shard)
+            except queue.Full:
+                raise HTTPException(status_code=503, detail="Usage ingestion is overloaded, please retry",
+                                    headers={"Retry-After": "1"})
+    else:
+        usage = Usage(tenant_id=tenant.id, user_id=current_user.id, feature=feature_code,
+                      timestamp=datetime.utcnow())
+        db.add(usage)
+        counts = rollup_counts([usage])
+        await db.run_sync(apply_rollup, counts)
+        await db.commit()
     return {"detail": f"Feature {feature_code} used successfully"}
 
+@router.post("/features/use/batch", response_model=schemas.FeatureUseBatchResponse)
+async def use_features_batch(batch: schemas.FeatureUseBatchRequest,
+                             db: AsyncSession = Depends(get_tenant_db),
+                             directory: AsyncSession = Depends(get_async_db),
+                             catalog: PlanCatalog = Depends(get_plan_catalog),
+                             context: dict = Depends(tenant_user_required)):
+    """Record several feature uses at once; returns a status per item."""
+    current_user = context["user"]
+    tenant = context["tenant"]
+    if tenant.plan_id is None:
+        raise HTTPException(status_code=402, detail="No plan selected. Please select a plan to use features.")
+    plan = catalog.get(tenant.plan_id)
+    if not plan:
+        await directory.run_sync(catalog.load)
+        plan = catalog.get(tenant.plan_id)
+    if not plan:
+        raise HTTPException(status_code=500, detail="Plan assigned to tenant not found")
+    now = datetime.utcnow()
+    results, rows = [], []
+    for index, item in enumerate(batch.items):
+        timestamp = utc_naive(item.timestamp or now)
+        detail = None
+        if int(item.feature[1:]) > plan["max_features"]:
+            detail = f"Feature {item.feature} is not available for your plan"
+        elif timestamp > now + MAX_CLOCK_SKEW or timestamp < now - MAX_BACKDATE:
+            detail = "Timestamp out of accepted range"
+        if detail:
+            results.append({"index": index, "feature": item.feature, "status": "rejected", "detail": detail})
+            continue
+        results.append({"index": index, "feature": item.feature, "status": "accepted"})
+        rows.append({"tenant_id": tenant.id, "user_id": current_user.id, "feature": item.feature,
+                     "timestamp": timestamp, "_result": results[-1]})
+    if rows:
+        # The whole batch is charged against the plan's rate limits in one call
+        feature_counts = {}
+        for row in rows:
+            feature_counts[row["feature"]] = feature_counts.get(row["feature"], 0) + 1
+        try:
+            retry_after = await check_feature_rate(plan, tenant.id, feature_counts)
+        except OverCapacity as err:
+            # Waiting won't help; the client has to split the batch
+            raise HTTPException(status_code=413, detail=f"Batch too large for your plan's rate limit: {err}")
+        if retry_after:
+            raise HTTPException(status_code=429, detail="Rate limit exceeded for your plan",
+                                headers={"Retry-After": str(retry_after)})
+        if USAGE_BUFFER_ENABLED:
+            for row in rows:
+                try:
+                    usage_buffer.add(row["tenant_id"], row["user_id"], row["feature"], row["timestamp"],
+                                     shard=tenant.shard, block=False)
+                except queue.Full:
+                    # Items that don't fit are reported individually so the client can resend just those
+                    row["_result"].update(status="rejected", detail="Usage ingestion is overloaded, please retry")
+        else:
+            # One multi-row INSERT plus rollup upsert, one commit
+            values = [{k: v for k, v in row.items() if k != "_result"} for row in rows]
+            await db.execute(insert(Usage), values)
+            await db.run_sync(apply_rollup, rollup_counts(values))
+            await db.commit()
+    accepted = sum(1 for r in results if r["status"] == "accepted")
+    return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}
+
+@router.get("/usage/analytics", response_model=schemas.UsageAnalytics)
+async def usage_analytics(start: Optional[datetime] = None,
+                          end: Optional[datetime] = None,
+                          bucket: str = Query("day", pattern="^(hour|day|week)$"),
+                          db: AsyncSession = Depends(get_tenant_db),
+                          context: dict = Depends(tenant_user_required)):
+    """Usage per feature over hour/day/week buckets in [start, end) (default: the last 30 buckets).
+
+    The range is widened to whole buckets and may span at most ANALYTICS_MAX_BUCKETS buckets
+    and ANALYTICS_MAX_RANGE. Results are cached until new usage is recorded
+    (or for ANALYTICS_CACHE_TTL).
+    """
+    # NumPy is only needed here; imported lazily to keep it out of app startup
+    from app.analytics import ANALYTICS_MAX_BUCKETS, ANALYTICS_MAX_RANGE, BUCKETS, align_range, hot_counts_query, \
+        usage_histogram
+    tenant = context["tenant"]
+    end = utc_naive(end) if end else datetime.utcnow()
+    start = utc_naive(start) if start else end - BUCKETS[bucket] * 30
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    start, end = align_range(start, end, bucket)
+    if (end - start) / BUCKETS[bucket] > ANALYTICS_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"At most {ANALYTICS_MAX_BUCKETS} buckets per request")
+    if end - start > ANALYTICS_MAX_RANGE:
+        raise HTTPException(status_code=400, detail=f"At most {ANALYTICS_MAX_RANGE.days} days per request")
+    # New usage raises the tenant's max usage id (one index lookup), a version every worker sees
+    version = (await db.execute(select(func.max(Usage.id)).where(Usage.tenant_id == tenant.id))).scalar()
+    key = (tenant.id, tenant.shard, start, end, bucket, version)
+    body = analytics_cache.get(key)
+    if body is MISSING:
+        # Hot usage is counted per hour/day in SQL, so only the aggregates come back
+        hot_counts = (await db.execute(
+            hot_counts_query(db.get_bind().dialect.name, tenant.id, start, end, bucket)
+        )).all()
+        # Bucketing (and reading archived months) is CPU/disk work, keep it off the event loop
+        histogram = await run_in_threadpool(usage_histogram, hot_counts, tenant.id, tenant.shard, start, end, bucket)
+        body = {"bucket": bucket, "start": start, "end": end, **histogram}
+        analytics_cache.set(key, body)
+    return body
+
+@router.get("/usage/export")
+async def export_usage(request: Request,
+                       start: Optional[datetime] = None,
+                       end: Optional[datetime] = None,
+                       format: str = Query("csv", pattern="^(csv|ndjson)$"),
+                       gzip: bool = False,
+                       after: Optional[str] = None,
+                       context: dict = Depends(tenant_user_required)):
+    """Download the tenant's raw usage events in [start, end) as CSV or NDJSON (tenant admin only).
+
+    Rows are ordered by (timestamp, id); resume an interrupted download with
+    `after=<timestamp>,<id>` of the last row received.
+    """
+    current_user = context["user"]
+    tenant = context["tenant"]
+    if not current_user.is_tenant_admin:
+        raise HTTPException(status_code=403, detail="Only tenant admin can export usage")
+    return usage_export_response(await routed_sessionmaker(request, tenant.shard), tenant.id, tenant.shard,
+                                 f"usage-{tenant.subdomain}", format, gzip, start, end, parse_cursor(after))
+
 @router.post("/billing/send", response_model=schemas.Message)
-def send_billing(db: Session = Depends(get_db), context: dict = Depends(tenant_user_required)):
-    """Trigger sending of billing email (async via Celery)."""
+async def send_billing(context: dict = Depends(tenant_user_required)):
+    """Queue billing of the usage recorded since the tenant's last bill (async via Celery)."""
     current_user = context["user"]
     tenant = context["tenant"]
     # Only tenant admin can trigger billing email
     if not current_user.is_tenant_admin:
         raise HTTPException(status_code=403, detail="Only tenant admin can send billing")
-    # Gather usage data (for simplicity, total count and by feature)
-    usages = db.query(Usage).filter(Usage.tenant_id == tenant.id).all()
-    total_usage = len(usages)
-    usage_counts = {}
-    for u in usages:
-        usage_counts[u.feature] = usage_counts.get(u.feature, 0) + 1
-    # In a real scenario, you might calculate costs here based on usage and plan.
-    # Compose a summary message
-    summary_lines = [f"{feat}: {count}" for feat, count in usage_counts.items()]
-    summary = "; ".join(summary_lines) if summary_lines else "No usage."
-    email_to = current_user.email  # assuming tenant admin's email for billing contact
-    # Enqueue Celery task
-    send_billing_email.delay(tenant.id, email_to, summary, total_usage)
+    # The worker does the aggregation and dedupes concurrent runs; this just drops rapid repeats
+    if billing_triggers.get(tenant.id) is MISSING:
+        billing_triggers.set(tenant.id, True)
+        # Enqueue Celery task (broker I/O is blocking); imported here to keep Celery out of app startup
+        from app.tasks.billing import bill_tenant
+        await run_in_threadpool(bill_tenant.delay, tenant.id)
     return {"detail": "Billing email has been queued for sending"}
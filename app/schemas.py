@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, TypeAdapter
+from typing import Dict, List, Optional
 from datetime import datetime
 
 # Shared base classes for DRY principle
@@ -16,8 +16,7 @@ class UserOut(UserBase):
     tenant_id: Optional[int] = None
     created_at: datetime
 
-    class Config:
-        orm_mode = True 
+    model_config = ConfigDict(from_attributes=True)
 
 class TenantBase(BaseModel):
     name: str = Field(..., max_length=100)
@@ -27,18 +26,21 @@ class TenantBase(BaseModel):
 class TenantCreate(TenantBase):
     admin_email: EmailStr
     admin_password: str = Field(..., min_length=6)
+    shard: Optional[str] = None  # defaults to NEW_TENANT_SHARD
 
 class TenantOut(TenantBase):
     id: int
     plan_id: Optional[int] = None
+    shard: Optional[str] = None
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class PlanBase(BaseModel):
     name: str
     max_features: int = Field(..., ge=0, le=10)  
+    tenant_rate_per_minute: Optional[int] = Field(None, ge=1)
+    feature_rate_per_minute: Optional[int] = Field(None, ge=1)
     
 class PlanCreate(PlanBase):
     pass
@@ -46,8 +48,7 @@ class PlanCreate(PlanBase):
 class PlanOut(PlanBase):
     id: int
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class LoginRequest(BaseModel):
     email: EmailStr
@@ -60,5 +61,37 @@ class TokenResponse(BaseModel):
 class FeatureUseRequest(BaseModel):
     feature: str = Field(..., pattern="^F[1-9][0-9]?$")  # matches "F1","F2",... up to F99 for example
 
+class FeatureUseItem(FeatureUseRequest):
+    timestamp: Optional[datetime] = None  # client-side time of use (UTC); defaults to receipt time
+
+class FeatureUseBatchRequest(BaseModel):
+    items: List[FeatureUseItem] = Field(..., min_length=1, max_length=1000)
+
+class FeatureUseItemResult(BaseModel):
+    index: int
+    feature: str
+    status: str  # "accepted" or "rejected"
+    detail: Optional[str] = None
+
+class FeatureUseBatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[FeatureUseItemResult]
+
+class UsageAnalytics(BaseModel):
+    bucket: str  # "hour", "day" or "week"
+    start: datetime
+    end: datetime
+    buckets: List[datetime]  # start of each bucket
+    features: Dict[str, List[int]]  # feature -> count per bucket
+    totals: Dict[str, int]
+
 class Message(BaseModel):
     detail: str
+
+# Serializers compiled once at import, for hot paths that bypass response_model
+PlanListAdapter = TypeAdapter(List[PlanOut])
+
+def response_columns(model, schema) -> list:
+    """ORM columns matching a response schema's fields, for list fast paths that skip model instances."""
+    return [getattr(model, name) for name in schema.model_fields]
@@ -1,14 +1,30 @@
 from passlib.context import CryptContext
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+import asyncio, os
 import jwt  # PyJWT
 
-# Password hashing context (using bcrypt)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 from os import getenv
+
+# Password hashing context (using bcrypt); raising BCRYPT_ROUNDS makes old hashes "need update"
+BCRYPT_ROUNDS = int(getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt runs in a dedicated process pool so a login burst can't hold the GIL for other requests.
+# BCRYPT_WORKERS=0 falls back to the default thread executor.
+BCRYPT_WORKERS = int(getenv("BCRYPT_WORKERS", str(os.cpu_count() or 1)))
+BCRYPT_MAX_CONCURRENCY = int(getenv("BCRYPT_MAX_CONCURRENCY", str(max(BCRYPT_WORKERS, 1))))
+BCRYPT_MAX_PENDING = int(getenv("BCRYPT_MAX_PENDING", "256"))  # waiting callers beyond this get HashingBusy
+
 SECRET_KEY = getenv("SECRET_KEY", "CHANGE_ME_SUPER_SECRET")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # example expiration time for tokens
+# When enabled, tokens carry role/tenant/admin claims plus the user's token version, and
+# get_current_user trusts them against a versioned in-process user cache instead of the DB.
+# Revoking tokens (revoke_user_tokens) only evicts the cache of the worker doing it: other
+# workers keep honouring a revoked token until their cached entry expires, i.e. for up to
+# USER_CACHE_TTL seconds (USER_CACHE_ADMIN_TTL for superadmins and tenant admins).
+AUTH_CLAIMS_MODE = getenv("AUTH_CLAIMS_MODE", "0").lower() in ("1", "true", "yes")
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -16,6 +32,63 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update(plain_password: str, hashed_password: str):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+def user_claims(user) -> dict:
+    """Token claims describing a user: identity, role, tenant, admin flags and token version."""
+    return {
+        "user_id": user.id,
+        "role": "superadmin" if user.is_superadmin else ("tenant_admin" if user.is_tenant_admin else "user"),
+        "tenant_id": user.tenant_id,
+        "is_superadmin": bool(user.is_superadmin),
+        "is_tenant_admin": bool(user.is_tenant_admin),
+        "ver": user.token_version or 0,
+    }
+
+class HashingBusy(Exception):
+    """Raised when too many password hashing requests are already waiting."""
+
+
+_hash_pool = None
+_hash_semaphore = None
+_hash_pending = 0
+
+def _get_hash_pool():
+    global _hash_pool
+    if _hash_pool is None and BCRYPT_WORKERS > 0:
+        _hash_pool = ProcessPoolExecutor(max_workers=BCRYPT_WORKERS)
+    return _hash_pool
+
+async def _run_hashing(func, *args):
+    global _hash_semaphore, _hash_pending
+    if _hash_semaphore is None:
+        _hash_semaphore = asyncio.Semaphore(BCRYPT_MAX_CONCURRENCY)
+    if _hash_pending >= BCRYPT_MAX_PENDING:
+        raise HashingBusy("Password hashing queue is full")
+    _hash_pending += 1
+    try:
+        async with _hash_semaphore:
+            return await asyncio.get_running_loop().run_in_executor(_get_hash_pool(), func, *args)
+    finally:
+        _hash_pending -= 1
+
+async def hash_password_async(password: str) -> str:
+    return await _run_hashing(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_hashing(verify_password, plain_password, hashed_password)
+
+async def verify_and_update_async(plain_password: str, hashed_password: str):
+    """Verify a password; returns (ok, new_hash) where new_hash is set when the stored hash needs upgrading."""
+    return await _run_hashing(verify_and_update, plain_password, hashed_password)
+
+def shutdown_hash_pool():
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown()
+        _hash_pool = None
+
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     to_encode = data.copy()
     if expires_delta:
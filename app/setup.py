@@ -0,0 +1,141 @@
+"""One-time database setup: create tables on every shard, upgrade existing ones, and seed the directory.
+
+Runs in a background thread on startup (AUTO_SETUP=1, the default) or once per deploy with
+`python -m app.setup`. Concurrent workers serialize on a database advisory lock, so only
+one of them does the work while the others find everything already in place.
+
+create_all only creates missing tables, so columns and indexes added to an existing table
+later are listed in ADDED_COLUMNS / ADDED_INDEXES and added with ALTER TABLE / CREATE
+INDEX where missing. On large MySQL tables, consider running `python -m app.setup` (or the
+equivalent online DDL) during a quiet period rather than on worker startup.
+"""
+from contextlib import contextmanager
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from threading import Thread
+import os, time
+
+from app import models, security
+from app.catalog import plan_catalog
+from app.models import Base
+from app.sharding import DEFAULT_SHARD, get_shard, shard_names
+
+AUTO_SETUP = os.getenv("AUTO_SETUP", "1").lower() in ("1", "true", "yes")
+SETUP_LOCK_NAME = "fastapi_multitenant_setup"
+SETUP_LOCK_TIMEOUT = 30
+SETUP_RETRIES = 5
+DEFAULT_PLANS = [("Basic", 2), ("Advanced", 4)]
+
+# Added to tables that already existed in earlier releases; each needs a server default or to be nullable
+ADDED_COLUMNS = [
+    models.Tenant.__table__.c.shard,        # per-tenant shards (app/sharding.py)
+    models.User.__table__.c.token_version,  # claims-based auth (app/dependencies.py)
+    models.Plan.__table__.c.tenant_rate_per_minute,   # plan rate limits (app/ratelimit.py)
+    models.Plan.__table__.c.feature_rate_per_minute,
+]
+ADDED_INDEXES = [index for index in models.Usage.__table__.indexes if index.name.startswith("ix_usages_")]
+
+# Read by /readyz
+setup_state = {"done": False, "error": None, "seconds": None}
+
+
+@contextmanager
+def advisory_lock(engine, name: str = SETUP_LOCK_NAME, timeout: int = SETUP_LOCK_TIMEOUT):
+    """Hold a named, database-wide lock (MySQL GET_LOCK / Postgres advisory lock; no-op elsewhere)."""
+    with engine.connect() as conn:
+        dialect = engine.dialect.name
+        if dialect == "mysql":
+            acquired = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"), {"name": name, "timeout": timeout}).scalar()
+            if not acquired:
+                raise TimeoutError(f"Could not acquire setup lock {name!r}")
+        elif dialect == "postgresql":
+            conn.execute(text("SELECT pg_advisory_lock(hashtext(:name))"), {"name": name})
+        try:
+            yield
+        finally:
+            if dialect == "mysql":
+                conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": name})
+            elif dialect == "postgresql":
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext(:name))"), {"name": name})
+
+
+def seed_directory(db):
+    """Create the initial superadmin (from env) and default plans if they don't exist."""
+    super_email = os.getenv("SUPERADMIN_EMAIL")
+    super_pass = os.getenv("SUPERADMIN_PASSWORD")
+    if super_email and super_pass:
+        existing = db.query(models.User.id).filter(models.User.is_superadmin == True).first()
+        if not existing:
+            db.add(models.User(email=super_email, name="Superadmin",
+                               password_hash=security.hash_password(super_pass),
+                               is_superadmin=True, is_tenant_admin=False))
+    names = {name for (name,) in db.query(models.Plan.name).filter(
+        models.Plan.name.in_([name for name, _ in DEFAULT_PLANS])).all()}
+    for name, max_feat in DEFAULT_PLANS:
+        if name not in names:
+            db.add(models.Plan(name=name, max_features=max_feat))
+    db.commit()
+
+
+def upgrade_schema(engine):
+    """Add the ADDED_COLUMNS and ADDED_INDEXES a shard's existing tables are missing."""
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for column in ADDED_COLUMNS:
+            if column.name not in {c["name"] for c in inspector.get_columns(column.table.name)}:
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {preparer.format_table(column.table)} ADD COLUMN {ddl}"))
+        for index in ADDED_INDEXES:
+            if index.name not in {i["name"] for i in inspector.get_indexes(index.table.name)}:
+                index.create(bind=conn)
+
+
+def setup_database():
+    started = time.perf_counter()
+    directory = get_shard(DEFAULT_SHARD)
+    # The database may still be booting (e.g. docker-compose), so retry a few times
+    retries = SETUP_RETRIES
+    while True:
+        try:
+            with advisory_lock(directory.engine):
+                # Create tables (for dev/demo purposes; in production use migrations)
+                for name in shard_names():
+                    Base.metadata.create_all(bind=get_shard(name).engine)
+                    upgrade_schema(get_shard(name).engine)
+                db = directory.SessionLocal()
+                try:
+                    seed_directory(db)
+                    # Warm the in-memory plan catalog
+                    plan_catalog.load(db)
+                finally:
+                    db.close()
+            break
+        except Exception as err:
+            retries -= 1
+            if retries <= 0:
+                print("Error: Could not set up database:", err)
+                raise
+            time.sleep(3)
+    setup_state["seconds"] = time.perf_counter() - started
+    setup_state["done"] = True
+
+
+def _run_in_background():
+    try:
+        setup_database()
+    except Exception as err:
+        setup_state["error"] = str(err)
+
+
+def start_background_setup():
+    """Kick off setup without blocking worker startup; /readyz reports when it's done."""
+    if not AUTO_SETUP:
+        setup_state["done"] = True
+        return
+    Thread(target=_run_in_background, name="db-setup", daemon=True).start()
+
+
+if __name__ == "__main__":
+    setup_database()
+    print(f"Database ready in {setup_state['seconds']:.2f}s")
@@ -0,0 +1,218 @@
+"""Tenant-to-shard database routing.
+
+The primary database (DATABASE_URL) doubles as the directory: it holds plans, superadmins and
+the authoritative `tenants` table, where `Tenant.shard` names the database that stores that
+tenant's users and usage. It is also the "default" shard. Extra shards are configured with
+SHARD_URLS, a JSON object of shard name -> SQLAlchemy URL, and get one connection pool each.
+
+Move a tenant between shards:
+
+    python -m app.sharding move <tenant_id> <target_shard>
+
+API workers cache tenant -> shard for TENANT_CACHE_TTL seconds, and a move only clears the
+caches of the process running it. After repointing the directory the move therefore waits
+out that TTL before purging the source, so stale workers keep reading the old copy instead
+of failing. The tenant must stay quiet for the whole move (copy + TENANT_CACHE_TTL): writes
+that land on the source in that window are lost with the purge.
+"""
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from threading import Lock
+import asyncio, heapq, json, os, sys, time
+
+from app.models import BillingPeriod, BillingWatermark, Tenant, User, Usage, UsageDaily
+
+DEFAULT_SHARD = "default"
+SHARD_URLS = json.loads(os.getenv("SHARD_URLS", "{}"))
+NEW_TENANT_SHARD = os.getenv("NEW_TENANT_SHARD", DEFAULT_SHARD)
+MOVE_CHUNK_SIZE = 1000
+
+
+def async_url(url: str) -> str:
+    """Map a sync driver URL to its async counterpart (pymysql -> aiomysql, sqlite -> aiosqlite)."""
+    url = url.replace("mysql+pymysql://", "mysql+aiomysql://", 1)
+    if url.startswith("sqlite://"):
+        url = url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+
+class Shard:
+    def __init__(self, name, engine, async_engine):
+        self.name = name
+        self.engine = engine
+        self.async_engine = async_engine
+        # session.info["shard"] lets shard-local helpers (e.g. rollup rebuilds) know where they run
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, info={"shard": name})
+        self.AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False,
+                                              expire_on_commit=False, info={"shard": name})
+
+
+_shards = {}
+_shards_lock = Lock()
+
+
+def shard_names() -> list:
+    return [DEFAULT_SHARD] + [name for name in SHARD_URLS if name != DEFAULT_SHARD]
+
+
+def get_shard(name: str) -> Shard:
+    """Return the Shard for a name, creating its engines (one pool per shard) on first use."""
+    shard = _shards.get(name)
+    if shard is not None:
+        return shard
+    with _shards_lock:
+        if name in _shards:
+            return _shards[name]
+        from app.metrics import instrument_engine
+        if name == DEFAULT_SHARD:
+            from app.dependencies import DATABASE_URL, ASYNC_DATABASE_URL
+            url, aurl = DATABASE_URL, ASYNC_DATABASE_URL
+        elif name in SHARD_URLS:
+            url = SHARD_URLS[name]
+            aurl = async_url(url)
+        else:
+            raise KeyError(f"Unknown shard {name!r}")
+        # Creating engines does no I/O; connections are opened on first use
+        shard = Shard(name, create_engine(url, pool_pre_ping=True), create_async_engine(aurl, pool_pre_ping=True))
+        instrument_engine(shard.engine)
+        instrument_engine(shard.async_engine.sync_engine)
+        _shards[name] = shard
+        return shard
+
+
+async def fan_out(func, names: list = None, read_only: bool = False) -> list:
+    """Run `await func(db)` against every shard concurrently; returns results in shard order.
+
+    With `read_only`, each shard is queried through a read replica when one is usable.
+    """
+    async def run(name):
+        if read_only:
+            from app.replicas import read_sessionmaker
+            session_factory = await read_sessionmaker(name)
+        else:
+            session_factory = get_shard(name).AsyncSessionLocal
+        async with session_factory() as db:
+            return await func(db)
+    return await asyncio.gather(*(run(name) for name in (names or shard_names())))
+
+
+def copy_tenant_row(db, tenant: Tenant):
+    """Ensure a shard has a copy of the directory tenant row (same id) so FKs resolve."""
+    if db.get(Tenant, tenant.id) is None:
+        db.add(Tenant(id=tenant.id, name=tenant.name, subdomain=tenant.subdomain,
+                      plan_id=None, shard=tenant.shard, created_at=tenant.created_at))
+        db.flush()
+
+
+def move_tenant(tenant_id: int, target: str, settle_seconds: float = None) -> dict:
+    """Copy a tenant's users and usage (hot and archived) to `target`, repoint the directory, then purge the source.
+
+    Users get new ids on the target; tokens carry the shard they were issued on, so tokens
+    issued before the move are rejected and users log in again. The source is purged only
+    after `settle_seconds` (default TENANT_CACHE_TTL), once other processes' caches expired.
+    """
+    from app.cache import TENANT_CACHE_TTL, tenant_cache, tenant_shard_cache
+    from app.archive import drop_tenant_archive, iter_tenant_archive
+    from app.rollup import rebuild_rollup
+    directory = get_shard(DEFAULT_SHARD).SessionLocal()
+    try:
+        tenant = directory.get(Tenant, tenant_id)
+        if tenant is None:
+            raise KeyError(f"Tenant {tenant_id} not found")
+        source = tenant.shard or DEFAULT_SHARD
+        if source == target:
+            return {"tenant_id": tenant_id, "users": 0, "usages": 0}
+        src = get_shard(source).SessionLocal()
+        dst = get_shard(target).SessionLocal()
+        try:
+            if target != DEFAULT_SHARD:
+                copy_tenant_row(dst, tenant)
+            # Users get new ids on the target; usages are remapped accordingly
+            user_ids = {}
+            users = src.execute(select(User).where(User.tenant_id == tenant_id)).scalars().all()
+            for start in range(0, len(users), MOVE_CHUNK_SIZE):
+                chunk = users[start:start + MOVE_CHUNK_SIZE]
+                copies = [User(email=u.email, name=u.name, password_hash=u.password_hash,
+                               is_superadmin=False, is_tenant_admin=u.is_tenant_admin, tenant_id=tenant_id,
+                               created_at=u.created_at, token_version=u.token_version) for u in chunk]
+                dst.add_all(copies)
+                dst.flush()
+                for old, new in zip(chunk, copies):
+                    user_ids[old.id] = new.id
+            moved_usages = 0
+            batch = []
+            # Copied in id order, so new ids keep the order and the billing watermark can be translated
+            watermark = src.get(BillingWatermark, tenant_id)
+            billed_rows = 0
+            hot_rows = src.execute(
+                select(Usage.id, Usage.user_id, Usage.feature, Usage.timestamp)
+                .where(Usage.tenant_id == tenant_id)
+                .order_by(Usage.id)
+                .execution_options(yield_per=MOVE_CHUNK_SIZE)
+            )
+            # Archived months are keyed by shard, so they land in the target's hot table and are
+            # archived again there by the next archive run
+            rows = heapq.merge(iter_tenant_archive(tenant_id, source), hot_rows, key=lambda r: r[0])
+            for usage_id, user_id, feature, timestamp in rows:
+                if watermark is not None and usage_id <= watermark.last_usage_id:
+                    billed_rows += 1
+                batch.append({"tenant_id": tenant_id, "user_id": user_ids.get(user_id),
+                              "feature": feature, "timestamp": timestamp})
+                if len(batch) >= MOVE_CHUNK_SIZE:
+                    dst.bulk_insert_mappings(Usage, batch)
+                    moved_usages += len(batch)
+                    batch = []
+            if batch:
+                dst.bulk_insert_mappings(Usage, batch)
+                moved_usages += len(batch)
+            if watermark is not None:
+                last_billed_id = 0
+                if billed_rows:
+                    last_billed_id = dst.execute(
+                        select(Usage.id).where(Usage.tenant_id == tenant_id)
+                        .order_by(Usage.id).offset(billed_rows - 1).limit(1)
+                    ).scalar()
+                dst.add(BillingWatermark(tenant_id=tenant_id, last_usage_id=last_billed_id,
+                                         billed_until=watermark.billed_until, updated_at=watermark.updated_at))
+                # Billing history is copied as is; its usage id ranges refer to the source shard
+                for period in src.execute(select(BillingPeriod).where(BillingPeriod.tenant_id == tenant_id)).scalars():
+                    dst.add(BillingPeriod(tenant_id=tenant_id, from_usage_id=period.from_usage_id,
+                                          to_usage_id=period.to_usage_id, period_start=period.period_start,
+                                          period_end=period.period_end, usage=period.usage,
+                                          total_usage=period.total_usage, run=period.run,
+                                          emailed_at=period.emailed_at, created_at=period.created_at))
+            dst.commit()
+            rebuild_rollup(dst, tenant_id)
+
+            tenant.shard = target
+            directory.commit()
+            tenant_cache.invalidate(tenant.subdomain)
+            tenant_shard_cache.invalidate(tenant_id)
+            # Other workers only see the new shard once their cached entry expires
+            time.sleep(TENANT_CACHE_TTL if settle_seconds is None else settle_seconds)
+
+            drop_tenant_archive(tenant_id, source)
+            src.execute(delete(BillingPeriod).where(BillingPeriod.tenant_id == tenant_id))
+            src.execute(delete(BillingWatermark).where(BillingWatermark.tenant_id == tenant_id))
+            src.execute(delete(UsageDaily).where(UsageDaily.tenant_id == tenant_id))
+            src.execute(delete(Usage).where(Usage.tenant_id == tenant_id))
+            src.execute(delete(User).where(User.tenant_id == tenant_id))
+            if source != DEFAULT_SHARD:
+                src.execute(delete(Tenant).where(Tenant.id == tenant_id))
+            src.commit()
+            return {"tenant_id": tenant_id, "users": len(user_ids), "usages": moved_usages}
+        finally:
+            src.close()
+            dst.close()
+    finally:
+        directory.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "move":
+        print(__doc__)
+        sys.exit(2)
+    from app.cache import TENANT_CACHE_TTL
+    print(f"Moving tenant {sys.argv[2]}; the source is purged {TENANT_CACHE_TTL:g}s after the directory is repointed")
+    print(move_tenant(int(sys.argv[2]), sys.argv[3]))
@@ -0,0 +1,135 @@
+"""Cross-tenant statistics for the superadmin console.
+
+A snapshot (tenants per plan, users per tenant, usage per feature over recent windows) is
+collected with a handful of grouped queries per shard by one Celery beat task every
+STATS_REFRESH_INTERVAL seconds (app/tasks/stats.py) and stored, pre-serialized, in the
+directory's platform_stats table. API workers only read that row, at most every
+STATS_RELOAD_INTERVAL seconds and only while /superadmin/stats is being requested, so the
+cross-shard scan runs once per interval however many workers there are. `generated_at`
+says how fresh the numbers are.
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+import os, time
+import orjson
+
+from app.models import Plan, PlatformStats, Tenant, Usage, UsageDaily, User
+from app.sharding import DEFAULT_SHARD, get_shard, shard_names
+
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", "60"))
+STATS_RELOAD_INTERVAL = float(os.getenv("STATS_RELOAD_INTERVAL", "5"))
+# Short windows count raw usage rows; day windows (including today) read the daily rollup
+RAW_WINDOWS = {"1h": timedelta(hours=1), "24h": timedelta(hours=24)}
+ROLLUP_WINDOWS = {"7d": 7, "30d": 30}
+
+
+def _shard_stats(db, now: datetime):
+    users = db.execute(
+        select(User.tenant_id, func.count(User.id)).where(User.tenant_id.isnot(None)).group_by(User.tenant_id)
+    ).all()
+    usage = {}
+    for window, delta in RAW_WINDOWS.items():
+        usage[window] = db.execute(
+            select(Usage.feature, func.count(Usage.id)).where(Usage.timestamp >= now - delta).group_by(Usage.feature)
+        ).all()
+    for window, days in ROLLUP_WINDOWS.items():
+        usage[window] = db.execute(
+            select(UsageDaily.feature, func.sum(UsageDaily.count))
+            .where(UsageDaily.day > now.date() - timedelta(days=days))
+            .group_by(UsageDaily.feature)
+        ).all()
+    return users, usage
+
+
+def collect_stats() -> dict:
+    """Run the grouped queries (directory + every shard) and merge the results."""
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    results = []
+    for name in shard_names():
+        db = get_shard(name).SessionLocal()
+        try:
+            if name == DEFAULT_SHARD:
+                plans = db.execute(
+                    select(Tenant.plan_id, Plan.name, func.count(Tenant.id))
+                    .select_from(Tenant).outerjoin(Plan, Plan.id == Tenant.plan_id)
+                    .group_by(Tenant.plan_id, Plan.name)
+                    .order_by(Tenant.plan_id)
+                ).all()
+            results.append(_shard_stats(db, now))
+        finally:
+            db.close()
+    users_per_tenant = {}
+    usage = {window: Counter() for window in (*RAW_WINDOWS, *ROLLUP_WINDOWS)}
+    for shard_users, shard_usage in results:
+        for tenant_id, count in shard_users:
+            users_per_tenant[str(tenant_id)] = users_per_tenant.get(str(tenant_id), 0) + count
+        for window, rows in shard_usage.items():
+            for feature, count in rows:
+                usage[window][feature] += int(count or 0)
+    return {
+        "generated_at": now.isoformat(),
+        "collect_seconds": round(time.perf_counter() - started, 3),
+        "tenants": sum(count for _, _, count in plans),
+        "users": sum(users_per_tenant.values()),
+        "tenants_per_plan": [{"plan_id": plan_id, "plan": name, "tenants": count} for plan_id, name, count in plans],
+        "users_per_tenant": users_per_tenant,
+        "usage": {window: dict(sorted(counts.items())) for window, counts in usage.items()},
+    }
+
+
+def refresh_stats() -> dict:
+    """Collect the stats and store them as the platform snapshot in the directory."""
+    stats = collect_stats()
+    values = {"body": orjson.dumps(stats).decode(), "generated_at": datetime.fromisoformat(stats["generated_at"])}
+    db = get_shard(DEFAULT_SHARD).SessionLocal()
+    try:
+        if not db.query(PlatformStats).filter(PlatformStats.id == 1).update(values):
+            db.add(PlatformStats(id=1, **values))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # first snapshot stored by a concurrent refresh
+            db.query(PlatformStats).filter(PlatformStats.id == 1).update(values)
+            db.commit()
+    finally:
+        db.close()
+    return stats
+
+
+class StatsSnapshot:
+    """The stored snapshot as a ready-to-send JSON body, reloaded at most every STATS_RELOAD_INTERVAL."""
+
+    def __init__(self, reload_interval: float = STATS_RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self.body = None
+        self.generated_at = None
+        self._loaded_at = None
+        self._requested_at = None
+
+    async def get(self, db):
+        """(body, generated_at) of the stored snapshot, or None if none has been collected yet."""
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.reload_interval:
+            row = (await db.execute(
+                select(PlatformStats.body, PlatformStats.generated_at).where(PlatformStats.id == 1)
+            )).first()
+            self._loaded_at = now
+            if row is not None:
+                self.body, self.generated_at = row.body.encode(), row.generated_at
+        if self.body is None:
+            return None
+        return self.body, self.generated_at
+
+    def should_request_refresh(self) -> bool:
+        """True at most once per STATS_REFRESH_INTERVAL, so a missing snapshot is requested once, not per request."""
+        now = time.monotonic()
+        if self._requested_at is not None and now - self._requested_at < STATS_REFRESH_INTERVAL:
+            return False
+        self._requested_at = now
+        return True
+
+
+stats_snapshot = StatsSnapshot()
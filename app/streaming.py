@@ -0,0 +1,33 @@
+from fastapi.responses import StreamingResponse
+import orjson
+
+# Helpers for large listings: keyset (cursor) pages and NDJSON streaming off a server-side cursor.
+STREAM_CHUNK_SIZE = 1000
+
+
+def keyset_page(stmt, id_column, limit: int = None, after: int = None):
+    """Restrict a select to the rows with id > after (at most `limit` of them, if given), ordered by id."""
+    if after is not None:
+        stmt = stmt.where(id_column > after)
+    stmt = stmt.order_by(id_column)
+    return stmt if limit is None else stmt.limit(limit)
+
+
+def rows_to_dicts(result) -> list:
+    """Column rows -> plain dicts, ready for orjson (no Pydantic model instances)."""
+    return [dict(row) for row in result.mappings()]
+
+
+def ndjson_response(session_factory, stmt, chunk_size: int = STREAM_CHUNK_SIZE) -> StreamingResponse:
+    """Stream a column select as newline-delimited JSON, reading through a server-side cursor.
+
+    The generator owns its session, so memory stays bounded by `chunk_size` regardless of
+    how many rows the statement returns.
+    """
+    async def rows():
+        async with session_factory() as db:
+            result = await db.stream(stmt.execution_options(yield_per=chunk_size))
+            async for partition in result.mappings().partitions(chunk_size):
+                yield b"".join(orjson.dumps(dict(row)) + b"\n" for row in partition)
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
@@ -1 +1,4 @@
-from .billing import send_billing_email
\ No newline at end of file
+from .billing import send_billing_email, bill_tenant, record_usage_fences
+from .archive import archive_usage
+from .billing_cycle import run_billing_cycle
+from .stats import refresh_platform_stats
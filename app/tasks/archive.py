@@ -0,0 +1,9 @@
+from .celery_app import celery_app
+
+@celery_app.task
+def archive_usage():
+    """Move usage older than the hot window into compressed segment files (see app/archive.py)."""
+    from app.archive import archive_all_shards
+    results = archive_all_shards()
+    print(f"[Usage Archive] {results}")
+    return results
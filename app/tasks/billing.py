@@ -1,4 +1,13 @@
 from .celery_app import celery_app
+from celery import group
+from datetime import datetime
+import json
+
+
+def format_summary(counts: dict) -> str:
+    summary_lines = [f"{feat}: {count}" for feat, count in sorted(counts.items())]
+    return "; ".join(summary_lines) if summary_lines else "No usage."
+
 
 @celery_app.task
 def send_billing_email(tenant_id: int, email_to: str, summary: str, total_usage: int):
@@ -8,3 +17,80 @@ def send_billing_email(tenant_id: int, email_to: str, summary: str, total_usage:
     print(f"Total Usage: {total_usage}")
     # Simulate email logic
     return "Billing email sent successfully"
+
+
+def queue_bill_emails(db, tenant_ids: list) -> int:
+    """Queue the statement email of each of these tenants' bills not emailed yet; returns emails queued.
+
+    Bills (BillingPeriod rows) are committed first and marked emailed only once their email is
+    queued, so a crash or broker error in between leaves them for the next caller to send
+    rather than losing them. (A crash right after queueing can send a statement twice.)
+    """
+    from app.billing import billing_contacts
+    from app.models import BillingPeriod
+    periods = db.query(BillingPeriod.id, BillingPeriod.tenant_id, BillingPeriod.usage, BillingPeriod.total_usage) \
+        .filter(BillingPeriod.tenant_id.in_(tenant_ids), BillingPeriod.emailed_at.is_(None)) \
+        .order_by(BillingPeriod.id) \
+        .all()
+    if not periods:
+        return 0
+    contacts = billing_contacts(db, tenant_ids)
+    # Bills of tenants without an admin wait until they have one
+    periods = [p for p in periods if p.tenant_id in contacts]
+    if not periods:
+        return 0
+    group(send_billing_email.s(p.tenant_id, contacts[p.tenant_id], format_summary(json.loads(p.usage)), p.total_usage)
+          for p in periods).apply_async()
+    db.query(BillingPeriod) \
+        .filter(BillingPeriod.id.in_([p.id for p in periods]), BillingPeriod.emailed_at.is_(None)) \
+        .update({BillingPeriod.emailed_at: datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return len(periods)
+
+
+@celery_app.task
+def record_usage_fences():
+    """Record every shard's current max usage id; bills stop at a settled fence (see app/billing.py)."""
+    from app.billing import record_fence
+    from app.sharding import get_shard, shard_names
+    fences = {}
+    for name in shard_names():
+        db = get_shard(name).SessionLocal()
+        try:
+            fences[name] = record_fence(db)
+        finally:
+            db.close()
+    return fences
+
+
+@celery_app.task(bind=True, max_retries=5)
+def bill_tenant(self, tenant_id: int):
+    """Bill a tenant for the usage recorded since its watermark, then queue the billing email.
+
+    Stops at the shard's settled usage fence; if there is none yet, the task retries once
+    BILLING_SETTLE_SECONDS have passed. See app/billing.py. Earlier bills whose email was
+    never queued are sent along.
+    """
+    from app.billing import BILLING_SETTLE_SECONDS, bill_tenants, settled_fence
+    from app.models import Tenant
+    from app.sharding import DEFAULT_SHARD, get_shard
+    directory = get_shard(DEFAULT_SHARD).SessionLocal()
+    try:
+        shard = directory.query(Tenant.shard).filter(Tenant.id == tenant_id).scalar()
+    finally:
+        directory.close()
+    if shard is None:
+        return {"tenant_id": tenant_id, "status": "unknown tenant"}
+    db = get_shard(shard).SessionLocal()
+    try:
+        through_id = settled_fence(db)
+        if through_id is None:
+            raise self.retry(countdown=BILLING_SETTLE_SECONDS)
+        counts = bill_tenants(db, shard, [tenant_id], through_id).get(tenant_id)
+        emails = queue_bill_emails(db, [tenant_id])
+    finally:
+        db.close()
+    if counts is None:
+        return {"tenant_id": tenant_id, "status": "nothing to bill", "emails": emails}
+    return {"tenant_id": tenant_id, "status": "billed", "total_usage": sum(counts.values()),
+            "through_usage_id": through_id, "emails": emails}
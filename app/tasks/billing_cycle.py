@@ -0,0 +1,95 @@
+from .celery_app import celery_app
+from .billing import queue_bill_emails
+from datetime import date, datetime, timedelta
+import os, time
+
+BILLING_CHUNK_SIZE = int(os.getenv("BILLING_CHUNK_SIZE", "500"))
+
+
+def previous_period(today: date = None) -> str:
+    first = (today or datetime.utcnow().date()).replace(day=1)
+    return (first - timedelta(days=1)).strftime("%Y-%m")
+
+def _bill_chunk(tenants, fences: dict, now: datetime, period: str) -> int:
+    """Bill one chunk of tenants for run `period`, one grouped query per shard; returns emails queued.
+
+    Tenants with nothing new since their last bill still get a (zero) statement. Tenants
+    this run already billed (before an interruption) are not billed again, but their bills
+    are emailed if that had not happened yet.
+    """
+    from app.billing import bill_tenants
+    from app.sharding import get_shard
+    by_shard = {}
+    for tenant_id, shard in tenants:
+        by_shard.setdefault(shard, []).append(tenant_id)
+    emails = 0
+    for shard, tenant_ids in by_shard.items():
+        db = get_shard(shard).SessionLocal()
+        try:
+            bill_tenants(db, shard, tenant_ids, fences[shard], now, run=period)
+            emails += queue_bill_emails(db, tenant_ids)
+        finally:
+            db.close()
+    return emails
+
+
+@celery_app.task(bind=True, max_retries=5)
+def run_billing_cycle(self, period: str = None):
+    """Bill every tenant for `period` ("YYYY-MM", default: last month), resuming an interrupted run.
+
+    Bills consume the same per-tenant watermarks as on-demand billing (app/billing.py): each
+    tenant is billed for its usage since its last bill, up to its shard's settled usage fence,
+    so usage billed on demand is never billed again here. `period` names the run; each bill
+    records it, so a resumed run skips tenants it already billed and only queues the emails
+    that were not queued before the interruption.
+    """
+    from app.billing import BILLING_SETTLE_SECONDS, settled_fence
+    from app.models import BillingRun, Tenant
+    from app.sharding import DEFAULT_SHARD, get_shard, shard_names
+    period = period or previous_period()
+    directory = get_shard(DEFAULT_SHARD).SessionLocal()
+    try:
+        run = directory.query(BillingRun).filter(BillingRun.period == period).first()
+        if run is None:
+            run = BillingRun(period=period, status="running", last_tenant_id=0, tenants_processed=0, emails_queued=0)
+            directory.add(run)
+            directory.commit()
+        elif run.status == "completed":
+            return {"period": period, "status": "already completed"}
+        now = datetime.utcnow()
+        fences = {}
+        for name in shard_names():
+            db = get_shard(name).SessionLocal()
+            try:
+                fences[name] = settled_fence(db, now)
+            finally:
+                db.close()
+        if None in fences.values():
+            raise self.retry(countdown=BILLING_SETTLE_SECONDS)
+        started = time.perf_counter()
+        processed = 0
+        while True:
+            tenants = directory.query(Tenant.id, Tenant.shard) \
+                .filter(Tenant.id > run.last_tenant_id) \
+                .order_by(Tenant.id) \
+                .limit(BILLING_CHUNK_SIZE) \
+                .all()
+            if not tenants:
+                break
+            emails = _bill_chunk(tenants, fences, now, period)
+            # Record progress after each chunk so a restart continues from here
+            run.last_tenant_id = tenants[-1][0]
+            run.tenants_processed += len(tenants)
+            run.emails_queued += emails
+            directory.commit()
+            processed += len(tenants)
+        run.status = "completed"
+        run.finished_at = datetime.utcnow()
+        directory.commit()
+        elapsed = time.perf_counter() - started
+        result = {"period": period, "tenants": run.tenants_processed, "emails": run.emails_queued,
+                  "seconds": round(elapsed, 2), "tenants_per_second": round(processed / elapsed, 1) if elapsed else None}
+        print(f"[Billing Cycle] {result}")
+        return result
+    finally:
+        directory.close()
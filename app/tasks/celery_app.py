@@ -1,14 +1,35 @@
 from celery import Celery
+from celery.schedules import crontab
 import os
 
 CELERY_BROKER = os.getenv("CELERY_BROKER", "redis://redis:6379/0")
+CELERY_BACKEND = os.getenv("CELERY_BACKEND", CELERY_BROKER)
+USAGE_FENCE_INTERVAL = float(os.getenv("USAGE_FENCE_INTERVAL", "60"))
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", "60"))
 
 celery_app = Celery(
     "worker",
     broker=CELERY_BROKER,
-    backend=CELERY_BROKER
+    backend=CELERY_BACKEND
 )
 
 celery_app.conf.task_routes = {
     "app.tasks.billing.send_billing_email": {"queue": "billing"},
+    "app.tasks.billing.bill_tenant": {"queue": "billing"},
+    "app.tasks.billing.record_usage_fences": {"queue": "maintenance"},
+    "app.tasks.archive.archive_usage": {"queue": "maintenance"},
+    "app.tasks.billing_cycle.run_billing_cycle": {"queue": "maintenance"},
+    "app.tasks.stats.refresh_platform_stats": {"queue": "maintenance"},
+}
+
+celery_app.conf.beat_schedule = {
+    # Keep the hot usages table to the last USAGE_HOT_MONTHS months
+    "archive-cold-usage": {"task": "app.tasks.archive.archive_usage", "schedule": 24 * 60 * 60},
+    # Usage fences: how far billing may read each shard's usage ids (see app/billing.py)
+    "record-usage-fences": {"task": "app.tasks.billing.record_usage_fences", "schedule": USAGE_FENCE_INTERVAL},
+    # Superadmin stats snapshot, collected once for every API worker (see app/stats.py)
+    "refresh-platform-stats": {"task": "app.tasks.stats.refresh_platform_stats", "schedule": STATS_REFRESH_INTERVAL},
+    # Bill last month's usage for every tenant
+    "monthly-billing-cycle": {"task": "app.tasks.billing_cycle.run_billing_cycle",
+                              "schedule": crontab(day_of_month=1, hour=2, minute=0)},
 }
@@ -0,0 +1,8 @@
+from .celery_app import celery_app
+
+@celery_app.task(expires=60)
+def refresh_platform_stats():
+    """Collect the superadmin stats across every shard and store the snapshot (see app/stats.py)."""
+    from app.stats import refresh_stats
+    stats = refresh_stats()
+    return {"generated_at": stats["generated_at"], "collect_seconds": stats["collect_seconds"]}
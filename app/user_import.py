@@ -0,0 +1,124 @@
+from pydantic import ValidationError
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+from app import schemas, security
+from app.models import User
+import asyncio, csv, io, json, os, time
+
+# Bulk user import for tenant admins. Rows are validated up front, duplicates are found with
+# one set-based query per chunk, passwords are hashed in parallel on the hashing pool, and
+# each chunk is inserted and committed on its own so progress can be streamed back.
+# Hashing goes BCRYPT_MAX_CONCURRENCY passwords at a time, so an import never fills the
+# hashing queue by itself; while other requests keep it full, rows wait for a free slot (up to
+# USER_IMPORT_HASH_WAIT seconds per chunk) and are then reported as "retry".
+USER_IMPORT_CHUNK_SIZE = int(os.getenv("USER_IMPORT_CHUNK_SIZE", "100"))
+USER_IMPORT_MAX_ROWS = int(os.getenv("USER_IMPORT_MAX_ROWS", "50000"))
+USER_IMPORT_HASH_WAIT = float(os.getenv("USER_IMPORT_HASH_WAIT", "30"))
+USER_IMPORT_BUSY_BACKOFF = 0.05  # seconds between attempts while the hashing queue is full
+
+
+def parse_rows(body: bytes, content_type: str) -> list:
+    """Parse a CSV (header: email,name,password) or JSON array body into a list of dicts."""
+    if "csv" in (content_type or ""):
+        return list(csv.DictReader(io.StringIO(body.decode("utf-8-sig"))))
+    data = json.loads(body or b"[]")
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of users")
+    return data
+
+
+def validate_rows(rows: list):
+    """Split rows into (valid [(row_number, UserCreate)], results for rejected rows)."""
+    valid, results, seen = [], [], set()
+    for number, raw in enumerate(rows, start=1):
+        try:
+            user_in = schemas.UserCreate.model_validate(raw)
+        except (ValidationError, TypeError) as err:
+            results.append({"row": number, "status": "invalid", "detail": str(err).replace("\n", " ")})
+            continue
+        email = user_in.email.lower()
+        if email in seen:
+            results.append({"row": number, "email": user_in.email, "status": "duplicate",
+                            "detail": "Repeated in this import"})
+            continue
+        seen.add(email)
+        valid.append((number, user_in))
+    return valid, results
+
+
+async def _hash_when_free(password: str, deadline: float):
+    while True:
+        try:
+            return await security.hash_password_async(password)
+        except security.HashingBusy:
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(USER_IMPORT_BUSY_BACKOFF)
+
+
+async def _hash_passwords(chunk: list) -> list:
+    """Hashes for a chunk's passwords, None for those still waiting for the hashing queue at the deadline."""
+    deadline = time.monotonic() + USER_IMPORT_HASH_WAIT
+    step = max(security.BCRYPT_MAX_CONCURRENCY, 1)
+    hashes = []
+    for start in range(0, len(chunk), step):
+        hashes += await asyncio.gather(*(_hash_when_free(u.password, deadline) for _, u in chunk[start:start + step]))
+    return hashes
+
+
+async def _insert_chunk(db, tenant_id: int, chunk: list, hashes: list) -> list:
+    values = [{"email": u.email, "name": u.name, "password_hash": h, "is_superadmin": False,
+               "is_tenant_admin": False, "tenant_id": tenant_id} for (_, u), h in zip(chunk, hashes)]
+    try:
+        await db.execute(insert(User), values)
+        await db.commit()
+        return [{"row": n, "email": u.email, "status": "created"} for n, u in chunk]
+    except IntegrityError:
+        # A concurrent insert raced us; fall back to row-by-row to pinpoint the conflicts
+        await db.rollback()
+    results = []
+    for (number, user_in), value in zip(chunk, values):
+        try:
+            await db.execute(insert(User), [value])
+            await db.commit()
+            results.append({"row": number, "email": user_in.email, "status": "created"})
+        except IntegrityError:
+            await db.rollback()
+            results.append({"row": number, "email": user_in.email, "status": "duplicate",
+                            "detail": "Email already in use in this tenant"})
+    return results
+
+
+async def import_users(session_factory, tenant_id: int, valid: list, rejected: list,
+                       chunk_size: int = USER_IMPORT_CHUNK_SIZE):
+    """Async generator of NDJSON lines: per-row results chunk by chunk, then a summary line."""
+    totals = {"created": 0, "duplicate": 0, "invalid": 0}
+
+    def emit(results):
+        for r in results:
+            totals[r["status"]] = totals.get(r["status"], 0) + 1
+        return "".join(json.dumps(r) + "\n" for r in results)
+
+    if rejected:
+        yield emit(rejected)
+    async with session_factory() as db:
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            # Emails compare case-insensitively, whatever the column's collation
+            emails = [u.email.lower() for _, u in chunk]
+            existing = {e.lower() for e in (await db.execute(
+                select(User.email).where(User.tenant_id == tenant_id, func.lower(User.email).in_(emails))
+            )).scalars().all()}
+            results = [{"row": n, "email": u.email, "status": "duplicate", "detail": "Email already in use in this tenant"}
+                       for n, u in chunk if u.email.lower() in existing]
+            chunk = [(n, u) for n, u in chunk if u.email.lower() not in existing]
+            if chunk:
+                hashes = await _hash_passwords(chunk)
+                results += [{"row": n, "email": u.email, "status": "retry",
+                             "detail": "Server busy hashing passwords; import this row again"}
+                            for (n, u), h in zip(chunk, hashes) if h is None]
+                hashed = [(row, h) for row, h in zip(chunk, hashes) if h is not None]
+                if hashed:
+                    results += await _insert_chunk(db, tenant_id, [row for row, _ in hashed], [h for _, h in hashed])
+            yield emit(sorted(results, key=lambda r: r["row"]))
+    yield json.dumps({"summary": totals}) + "\n"
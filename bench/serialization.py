@@ -0,0 +1,62 @@
+"""Serialization CPU benchmark: the old list path vs. the orjson column fast path.
+
+Measures CPU time (time.process_time) per simulated list response of N rows, without a
+database, so the numbers isolate response serialization:
+
+    legacy     ORM-like objects -> Pydantic models -> jsonable_encoder -> json.dumps
+    validated  ORM-like objects -> TypeAdapter(List[UserOut]).dump_json (compiled serializer)
+    fast_path  column dicts -> orjson.dumps (what the list endpoints now do)
+
+    python -m bench.serialization --rows 1000 --repeat 50
+"""
+import argparse, json, time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from app import schemas
+
+
+def make_rows(n: int) -> list:
+    now = datetime.utcnow()
+    return [dict(id=i, email=f"user{i}@example.com", name=f"User {i}", is_tenant_admin=(i == 0),
+                 tenant_id=1 + i % 20, created_at=now - timedelta(minutes=i)) for i in range(n)]
+
+
+def cpu_per_call(func, repeat: int) -> float:
+    func()  # warm up
+    started = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per response")
+    parser.add_argument("--repeat", type=int, default=50, help="responses per variant")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    objects = [SimpleNamespace(**r) for r in rows]
+    adapter = TypeAdapter(List[schemas.UserOut])
+
+    variants = {
+        "legacy": lambda: json.dumps(jsonable_encoder(
+            [schemas.UserOut.model_validate(o) for o in objects])).encode(),
+        "validated": lambda: adapter.dump_json(adapter.validate_python(objects, from_attributes=True)),
+        "fast_path": lambda: orjson.dumps(rows),
+    }
+    results = {name: cpu_per_call(func, args.repeat) for name, func in variants.items()}
+    baseline = results["legacy"]
+    print(f"{'variant':<12}{'cpu ms/resp':>14}{'us/row':>10}{'speedup':>10}")
+    for name, seconds in results.items():
+        print(f"{name:<12}{seconds * 1000:>14.2f}{seconds * 1e6 / args.rows:>10.2f}{baseline / seconds:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Cold-start benchmark: time `import app.main` and the startup hooks in fresh interpreters.
+
+    python -m bench.startup --runs 5 --budget 1.0   # exits non-zero when over budget
+"""
+import argparse, json, os, statistics, subprocess, sys
+
+PROBE = """
+import time
+started = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+import asyncio
+asyncio.run(app.main.app.router.startup())
+ready = time.perf_counter()
+print(__import__("json").dumps({"import": imported - started, "startup": ready - imported}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds allowed for import + startup")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+    env.setdefault("AUTO_SETUP", "0")
+    samples = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True)
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    imports = [s["import"] for s in samples]
+    startups = [s["startup"] for s in samples]
+    totals = [s["import"] + s["startup"] for s in samples]
+    print(f"import   median {statistics.median(imports) * 1000:.1f}ms  max {max(imports) * 1000:.1f}ms")
+    print(f"startup  median {statistics.median(startups) * 1000:.1f}ms  max {max(startups) * 1000:.1f}ms")
+    print(f"total    median {statistics.median(totals) * 1000:.1f}ms  budget {args.budget * 1000:.0f}ms")
+    if statistics.median(totals) > args.budget:
+        print("OVER BUDGET")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# Configure the app for an in-process sqlite database before any app module is imported
+import json, os, tempfile
+
+_tmp = tempfile.mkdtemp(prefix="multitenant-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/test.db")
+os.environ.setdefault("SHARD_URLS", json.dumps({"s2": f"sqlite:///{_tmp}/s2.db"}))
+os.environ.setdefault("USAGE_ARCHIVE_DIR", os.path.join(_tmp, "usage_archive"))
+os.environ.setdefault("AUTO_SETUP", "0")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import pytest
+
+from app.models import Base
+from app.sharding import DEFAULT_SHARD, get_shard, shard_names
+
+
+@pytest.fixture
+def db():
+    """A session on the default shard; every shard's tables (and the archive) start empty."""
+    from app.archive import pending_paths, segment_paths
+    for name in shard_names():
+        Base.metadata.create_all(bind=get_shard(name).engine)
+    session = get_shard(DEFAULT_SHARD).SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        for name in shard_names():
+            Base.metadata.drop_all(bind=get_shard(name).engine)
+        for path in segment_paths() + pending_paths():
+            os.remove(path)
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import archive
+from app.analytics import align_range, hot_counts_query, usage_histogram
+from app.models import Tenant, Usage
+
+
+def histogram(db, start, end, bucket):
+    start, end = align_range(start, end, bucket)
+    hot_counts = db.execute(hot_counts_query("sqlite", 1, start, end, bucket)).all()
+    return usage_histogram(hot_counts, 1, "default", start, end, bucket)
+
+
+@pytest.fixture
+def usage(db):
+    db.add(Tenant(id=1, name="A", subdomain="a"))
+    t0 = datetime(2020, 1, 6, 10, 15)  # a Monday
+    db.add_all([Usage(tenant_id=1, feature="F1", timestamp=t0), Usage(tenant_id=1, feature="F1", timestamp=t0),
+                Usage(tenant_id=1, feature="F2", timestamp=t0 + timedelta(hours=1, minutes=50)),
+                Usage(tenant_id=1, feature="F1", timestamp=t0 + timedelta(days=8)),
+                Usage(tenant_id=2, feature="F1", timestamp=t0)])
+    db.commit()
+    return t0
+
+
+def test_histogram_counts_hot_usage_in_sql_buckets(db, usage):
+    t0 = usage
+    by_hour = histogram(db, t0, t0 + timedelta(hours=3), "hour")
+    assert by_hour["buckets"][0] == "2020-01-06T10:00:00"
+    assert by_hour["features"] == {"F1": [2, 0, 0, 0], "F2": [0, 0, 1, 0]}  # widened to 10:00-14:00
+    by_day = histogram(db, t0, t0 + timedelta(days=9), "day")
+    assert by_day["features"]["F1"] == [2, 0, 0, 0, 0, 0, 0, 0, 1, 0]
+    assert by_day["totals"] == {"F1": 3, "F2": 1}
+    assert histogram(db, t0, t0 + timedelta(days=14), "week")["features"] == {"F1": [2, 1, 0], "F2": [1, 0, 0]}
+
+
+def test_histogram_adds_archived_months(db, usage):
+    old = datetime(2019, 12, 31, 23, 30)
+    db.add_all([Usage(tenant_id=1, feature="F2", timestamp=old), Usage(tenant_id=1, feature="F3", timestamp=old)])
+    db.commit()
+    assert archive.archive_month(db, "default", old.date().replace(day=1)) == 2
+    # The week of Monday 2019-12-30 holds archived and hot usage
+    weeks = histogram(db, old, usage + timedelta(days=1), "week")
+    assert weeks["buckets"] == ["2019-12-30T00:00:00", "2020-01-06T00:00:00"]
+    assert weeks["features"] == {"F1": [0, 2], "F2": [1, 1], "F3": [1, 0]}
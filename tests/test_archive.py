@@ -0,0 +1,116 @@
+from datetime import date, datetime, timedelta
+import os
+
+from app import archive
+from app.models import BillingWatermark, Tenant, Usage, UsageDaily, User
+from app.sharding import get_shard, move_tenant
+
+MONTH = date(2020, 1, 1)
+
+
+def segment(name: str) -> str:
+    os.makedirs(archive.USAGE_ARCHIVE_DIR, exist_ok=True)
+    return os.path.join(archive.USAGE_ARCHIVE_DIR, name)
+
+
+def test_segment_round_trip(db):
+    t0 = datetime(2020, 1, 10, 12, 30, 0, 123456)
+    rows = [(3, 2, None, "F2", t0), (1, 1, 7, "F1", t0 + timedelta(hours=1)), (2, 1, 8, "F2", t0)]
+    path = segment("usage-default-2020-01-0.seg")
+    archive.write_segment(path, "default", MONTH, list(rows))
+    meta, cols = archive.read_segment(path)
+    assert meta["rows"] == 3 and meta["features"] == ["F1", "F2"] and meta["month"] == "2020-01-01"
+    # Sorted by (tenant_id, timestamp); a missing user is stored as -1
+    assert list(cols["tenant_id"]) == [1, 1, 2]
+    assert list(cols["id"]) == [2, 1, 3]
+    assert list(cols["user_id"]) == [8, 7, -1]
+    assert list(archive.iter_archived_events(1, shard="default")) == [
+        (2, t0, "F2", 8), (1, t0 + timedelta(hours=1), "F1", 7)]
+    assert list(archive.iter_archived_events(2, shard="default")) == [(3, t0, "F2", None)]
+
+
+def test_archived_events_merge_parts_and_filter_range(db):
+    t0 = datetime(2020, 1, 10)
+    archive.write_segment(segment("usage-default-2020-01-0.seg"), "default", MONTH,
+                          [(5, 1, None, "F1", t0), (6, 1, None, "F1", t0 + timedelta(days=2))])
+    archive.write_segment(segment("usage-default-2020-01-1.seg"), "default", MONTH,
+                          [(9, 1, None, "F2", t0 + timedelta(days=1)), (4, 1, None, "F2", t0)])
+    events = list(archive.iter_archived_events(1, shard="default"))
+    assert [e[0] for e in events] == [4, 5, 9, 6]  # (timestamp, id) order across parts
+    in_range = archive.iter_archived_events(1, t0 + timedelta(hours=1), t0 + timedelta(days=2), "default")
+    assert [e[0] for e in in_range] == [9]
+    assert archive.archived_daily_counts(1, "default") == {
+        (1, "F1", t0.date()): 1, (1, "F2", t0.date()): 1, (1, "F1", (t0 + timedelta(days=2)).date()): 1,
+        (1, "F2", (t0 + timedelta(days=1)).date()): 1}
+
+
+def test_move_tenant_carries_archived_months(db):
+    db.add_all([Tenant(id=1, name="A", subdomain="a"), Tenant(id=2, name="B", subdomain="b")])
+    db.add(User(email="a@a.test", password_hash="x", tenant_id=1))
+    db.commit()
+    old = datetime(2020, 1, 15)
+    db.add_all([Usage(tenant_id=1, feature="F1", timestamp=old), Usage(tenant_id=2, feature="F1", timestamp=old),
+                Usage(tenant_id=1, feature="F2", timestamp=old)])
+    db.commit()
+    db.add_all([Usage(tenant_id=1, feature="F1"), Usage(tenant_id=1, feature="F2")])
+    # Billed through the first hot row: 2 archived + 1 hot row of tenant 1
+    db.add(BillingWatermark(tenant_id=1, last_usage_id=4))
+    db.commit()
+    assert archive.archive_month(db, "default", MONTH) == 3
+
+    assert move_tenant(1, "s2", settle_seconds=0)["usages"] == 4
+    dst = get_shard("s2").SessionLocal()
+    try:
+        moved = dst.query(Usage.id, Usage.feature, Usage.timestamp).order_by(Usage.id).all()
+        assert [(f, ts.date() == old.date()) for _, f, ts in moved] == [
+            ("F1", True), ("F2", True), ("F1", False), ("F2", False)]
+        assert dst.get(BillingWatermark, 1).last_usage_id == moved[2].id
+        daily = dict(dst.query(UsageDaily.feature, UsageDaily.count).filter(UsageDaily.day == old.date()))
+        assert daily == {"F1": 1, "F2": 1}
+    finally:
+        dst.close()
+    # The source archive keeps the other tenant only
+    assert list(archive.iter_archived_events(1, shard="default")) == []
+    assert len(list(archive.iter_archived_events(2, shard="default"))) == 1
+
+
+def add_old_usage(db, count: int):
+    db.add(Tenant(id=1, name="A", subdomain="a"))
+    db.add_all([Usage(tenant_id=1, feature="F1", timestamp=datetime(2020, 1, 1 + i)) for i in range(count)])
+    db.add(Usage(tenant_id=1, feature="F1"))  # stays hot
+    db.commit()
+
+
+def test_archive_month_writes_bounded_parts(db, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_PART_ROWS", 2)
+    add_old_usage(db, 5)
+    assert archive.archive_month(db, "default", MONTH) == 5
+    assert [os.path.basename(p) for p in archive.segment_paths("default")] == [
+        f"usage-default-2020-01-{part}.seg" for part in range(3)]
+    assert [e[0] for e in archive.iter_archived_events(1, shard="default")] == [1, 2, 3, 4, 5]
+    assert db.query(Usage).count() == 1
+
+
+def test_archive_month_recovers_after_crash(db, monkeypatch):
+    add_old_usage(db, 3)
+
+    def crash(*args):
+        raise RuntimeError("killed after writing the segment")
+    monkeypatch.setattr(archive, "_delete_ids", crash)
+    try:
+        archive.archive_month(db, "default", MONTH)
+    except RuntimeError:
+        db.rollback()
+    monkeypatch.undo()
+    assert db.query(Usage).count() == 4  # written to a part but still hot
+    assert list(archive.iter_archived_events(1, shard="default")) == []  # ... and the part is not visible yet
+
+    # The re-run drops the rows already archived instead of writing them again
+    assert archive.archive_month(db, "default", MONTH) == 0
+    assert db.query(Usage).count() == 1
+    assert len(list(archive.iter_archived_events(1, shard="default"))) == 3
+    db.add(Usage(tenant_id=1, feature="F2", timestamp=datetime(2020, 1, 20)))  # late row
+    db.commit()
+    assert archive.archive_month(db, "default", MONTH) == 1
+    assert len(archive.segment_paths("default")) == 2
+    assert archive.archived_daily_counts(1, "default")[(1, "F1", date(2020, 1, 1))] == 1
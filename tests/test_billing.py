@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import archive, billing
+from app.models import BillingPeriod, BillingWatermark, Tenant, Usage, User
+
+
+@pytest.fixture
+def tenant(db):
+    tenant = Tenant(id=1, name="Acme", subdomain="acme")
+    db.add(tenant)
+    db.add(User(email="admin@acme.test", password_hash="x", is_tenant_admin=True, tenant_id=1))
+    db.commit()
+    return tenant
+
+
+def add_usage(db, *features, tenant_id=1, timestamp=None):
+    rows = [Usage(tenant_id=tenant_id, feature=f, timestamp=timestamp or datetime.utcnow()) for f in features]
+    db.add_all(rows)
+    db.commit()
+    return [r.id for r in rows]
+
+
+def settle(db):
+    """The fence recorded now, as seen once it has settled."""
+    now = datetime.utcnow()
+    billing.record_fence(db, now)
+    return billing.settled_fence(db, now + timedelta(seconds=billing.BILLING_SETTLE_SECONDS))
+
+
+def test_settled_fence_waits_for_settle_lag(db, tenant):
+    add_usage(db, "F1", "F1")
+    now = datetime.utcnow()
+    assert billing.settled_fence(db, now) is None  # records a fence, not settled yet
+    assert billing.settled_fence(db, now + timedelta(seconds=1)) is None
+    assert billing.settled_fence(db, now + timedelta(seconds=billing.BILLING_SETTLE_SECONDS)) == 2
+
+
+def test_bill_stops_at_fence(db, tenant):
+    add_usage(db, "F1", "F1", "F2")
+    fence = settle(db)
+    add_usage(db, "F1")  # after the fence: left for the next bill
+    assert billing.bill_tenants(db, "default", [1], fence) == {1: {"F1": 2, "F2": 1}}
+    assert db.get(BillingWatermark, 1).last_usage_id == fence
+    assert billing.bill_tenants(db, "default", [1], fence) == {}
+
+    fence = settle(db)
+    assert billing.bill_tenants(db, "default", [1], fence) == {1: {"F1": 1}}
+    periods = db.query(BillingPeriod).order_by(BillingPeriod.id).all()
+    assert [(p.from_usage_id, p.to_usage_id, p.total_usage) for p in periods] == [(0, 3, 3), (3, 4, 1)]
+
+
+def test_bill_skips_tenant_whose_watermark_moved(db, tenant):
+    add_usage(db, "F1")
+    fence = settle(db)
+    billing.bill_tenants(db, "default", [1], 0)  # creates the watermark
+    # A concurrent run bills first: the compare-and-set from the stale watermark must not bill again
+    db.query(BillingWatermark).update({BillingWatermark.last_usage_id: fence})
+    db.commit()
+    assert billing.bill_tenants(db, "default", [1], fence) == {}
+    assert db.query(BillingPeriod).count() == 0
+
+
+def test_bill_counts_archived_rows(db, tenant):
+    old = datetime(2020, 1, 15)
+    ids = add_usage(db, "F1", "F2", timestamp=old)
+    add_usage(db, "F2")
+    assert archive.archive_month(db, "default", old.date().replace(day=1)) == len(ids)
+    fence = settle(db)
+    assert billing.bill_tenants(db, "default", [1], fence) == {1: {"F1": 1, "F2": 2}}
+    assert billing.bill_tenants(db, "default", [1], fence) == {}
+
+
+def test_bill_during_interrupted_archive(db, tenant, monkeypatch):
+    old = datetime(2020, 1, 15)
+    add_usage(db, "F1", "F1", "F1", timestamp=old)
+    add_usage(db, "F2")
+
+    def crash(*args):
+        raise RuntimeError("killed before deleting the archived rows")
+    monkeypatch.setattr(archive, "_delete_ids", crash)
+    with pytest.raises(RuntimeError):
+        archive.archive_month(db, "default", old.date().replace(day=1))
+    db.rollback()
+    monkeypatch.undo()
+    # The part is written but still pending: its rows are billed once, from the hot table
+    assert archive.pending_paths("default") and not archive.segment_paths("default")
+    fence = settle(db)
+    assert billing.bill_tenants(db, "default", [1], fence) == {1: {"F1": 3, "F2": 1}}
+
+    # The re-run publishes the part; the rows now archived are not billed again
+    assert archive.archive_month(db, "default", old.date().replace(day=1)) == 0
+    assert archive.segment_paths("default") and not archive.pending_paths("default")
+    assert db.query(Usage).count() == 1
+    assert billing.bill_tenants(db, "default", [1], settle(db)) == {}
+
+
+class Outbox:
+    """Stands in for celery's group: records the email tasks queued, or fails like a broker that is down."""
+
+    def __init__(self):
+        self.sent = []
+        self.failing = False
+
+    def __call__(self, signatures):
+        signatures = list(signatures)
+        outbox = self
+
+        class Group:
+            def apply_async(self):
+                if outbox.failing:
+                    raise ConnectionError("broker unavailable")
+                outbox.sent += [s.args for s in signatures]
+        return Group()
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    from app.tasks import billing as billing_tasks
+    outbox = Outbox()
+    monkeypatch.setattr(billing_tasks, "group", outbox)
+    return outbox
+
+
+def test_cycle_consumes_the_watermark(db, tenant, outbox):
+    from app.tasks.billing_cycle import _bill_chunk
+    add_usage(db, "F1", "F1")
+    fence = settle(db)
+    assert billing.bill_tenants(db, "default", [1], fence) == {1: {"F1": 2}}
+    # Usage billed on demand is not billed again by the cycle
+    assert _bill_chunk([(1, "default")], {"default": fence}, datetime.utcnow(), "2020-01") == 2
+    assert outbox.sent == [(1, "admin@acme.test", "F1: 2", 2), (1, "admin@acme.test", "No usage.", 0)]
+    add_usage(db, "F2")
+    assert _bill_chunk([(1, "default")], {"default": settle(db)}, datetime.utcnow(), "2020-02") == 1
+    assert outbox.sent[-1] == (1, "admin@acme.test", "F2: 1", 1)
+    assert db.query(BillingPeriod).count() == 3
+
+
+def test_resumed_cycle_emails_committed_bills(db, tenant, outbox):
+    from app.tasks.billing_cycle import _bill_chunk
+    add_usage(db, "F1", "F2")
+    fence = settle(db)
+    outbox.failing = True
+    with pytest.raises(ConnectionError):
+        _bill_chunk([(1, "default")], {"default": fence}, datetime.utcnow(), "2020-01")
+    db.expire_all()
+    assert db.query(BillingPeriod.emailed_at).one() == (None,)  # billed, not emailed
+
+    # The resumed run does not bill the tenant again, and sends the bill it made before
+    outbox.failing = False
+    add_usage(db, "F1")
+    assert _bill_chunk([(1, "default")], {"default": settle(db)}, datetime.utcnow(), "2020-01") == 1
+    assert outbox.sent == [(1, "admin@acme.test", "F1: 1; F2: 1", 2)]
+    assert _bill_chunk([(1, "default")], {"default": settle(db)}, datetime.utcnow(), "2020-01") == 0
+    assert db.query(BillingPeriod).count() == 1
+    db.expire_all()
+    assert db.query(BillingPeriod.emailed_at).one()[0] is not None
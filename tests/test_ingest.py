@@ -0,0 +1,63 @@
+from app import ingest
+from app.ingest import UsageBuffer
+from app.models import Tenant, Usage, UsageDaily
+from app.sharding import get_shard
+
+
+class FlakySessions:
+    """Session factory whose sessions fail to commit while `failing` is set."""
+
+    def __init__(self):
+        self.failing = False
+
+    def __call__(self, shard):
+        db = get_shard(shard).SessionLocal()
+        if self.failing:
+            def commit():
+                raise RuntimeError("database unavailable")
+            db.commit = commit
+        return db
+
+
+def test_failed_flush_is_retried(db):
+    db.add(Tenant(id=1, name="A", subdomain="a"))
+    db.commit()
+    sessions = FlakySessions()
+    buffer = UsageBuffer(sessions)
+    sessions.failing = True
+    buffer.add(1, None, "F1")
+    buffer.add(1, None, "F2")
+    assert buffer.flush() == 0
+    assert buffer.stats()["retrying"] == 2
+    assert buffer.flush() == 0  # not due yet
+
+    sessions.failing = False
+    buffer._failed[0]["retry_at"] = 0
+    assert buffer.flush() == 2
+    assert db.query(Usage).count() == 2
+    assert sum(c for (c,) in db.query(UsageDaily.count)) == 2
+    assert buffer.stats()["retrying"] == 0 and buffer.stats()["dropped"] == 0
+
+
+def test_failed_flush_is_dropped_after_retry_window(db, monkeypatch):
+    monkeypatch.setattr(ingest, "USAGE_FLUSH_RETRY_SECONDS", 0)
+    sessions = FlakySessions()
+    sessions.failing = True
+    buffer = UsageBuffer(sessions)
+    buffer.add(1, None, "F1")
+    assert buffer.flush() == 0
+    assert buffer.stats()["dropped"] == 1 and buffer.stats()["retrying"] == 0
+
+
+def test_failed_rows_hold_back_new_rows(db):
+    sessions = FlakySessions()
+    sessions.failing = True
+    buffer = UsageBuffer(sessions, maxsize=2)
+    buffer.add(1, None, "F1")
+    buffer.add(1, None, "F1")
+    buffer.flush()
+    buffer.add(1, None, "F2")
+    buffer._failed[0]["retry_at"] = float("inf")
+    buffer.flush()
+    # Capacity is taken by the failing batch, so the new row waits in the queue
+    assert buffer.stats()["depth"] == 1 and buffer.stats()["retrying"] == 2
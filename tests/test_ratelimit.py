@@ -0,0 +1,93 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from app import ratelimit
+from app.ratelimit import LocalLimiter, OverCapacity, RedisLimiter
+
+
+class Clock:
+    """Stands in for the time module so bucket refill can be stepped."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def run():
+    """Run coroutines on one event loop for the whole test (the fake Redis client is bound to it)."""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(params=["local", "redis"])
+def limiter(request, clock):
+    if request.param == "local":
+        return LocalLimiter()
+    return RedisLimiter(fakeredis.aioredis.FakeRedis())
+
+
+@pytest.fixture
+def acquire(limiter, run):
+    return lambda buckets: run(limiter.acquire(buckets))
+
+
+def test_bucket_consumes_and_refills(acquire, clock):
+    assert acquire([("a", 60, 50)]) == 0
+    assert acquire([("a", 60, 10)]) == 0
+    # Empty: 5 tokens at one per second
+    assert acquire([("a", 60, 5)]) == pytest.approx(5)
+    clock.now += 2
+    assert acquire([("a", 60, 5)]) == pytest.approx(3)
+    clock.now += 3
+    assert acquire([("a", 60, 5)]) == 0
+    # Refill stops at the bucket size
+    clock.now += 3600
+    assert acquire([("a", 60, 60)]) == 0
+    assert acquire([("a", 60, 1)]) > 0
+
+
+def test_buckets_are_charged_together_or_not_at_all(acquire):
+    assert acquire([("tenant", 100, 10), ("feature", 10, 10)]) == 0
+    # The feature bucket is empty, so the tenant bucket is not charged either
+    assert acquire([("tenant", 100, 5), ("feature", 10, 5)]) == pytest.approx(30)
+    assert acquire([("tenant", 100, 90)]) == 0
+    assert acquire([("other", 10, 10)]) == 0
+
+
+def test_local_limiter_bounds_its_keys(clock, run):
+    limiter = LocalLimiter(max_keys=2)
+    for key in ("a", "b", "c"):
+        assert run(limiter.acquire([(key, 1, 1)])) == 0
+    assert len(limiter._buckets) <= 2
+
+
+def test_check_feature_rate(monkeypatch, limiter, run):
+    monkeypatch.setattr(ratelimit, "limiter", limiter)
+    plan = {"tenant_rate_per_minute": 10, "feature_rate_per_minute": 4}
+    check = lambda counts: run(ratelimit.check_feature_rate(plan, 1, counts))
+    assert check({"F1": 4, "F2": 4}) is None
+    assert check({"F1": 1}) == 15  # F1 is empty: one token takes 15s, rounded up
+    assert check({"F2": 1}) == 15
+    assert check({"F3": 2}) is None  # tenant bucket still had 2
+    assert check({"F3": 1}) == 6
+    with pytest.raises(OverCapacity):
+        check({"F4": 5})
+    with pytest.raises(OverCapacity):
+        check({"F4": 4, "F5": 4, "F6": 4})
+    assert run(ratelimit.check_feature_rate({}, 1, {"F1": 100})) is None
@@ -0,0 +1,36 @@
+import asyncio
+
+import orjson
+
+from app.models import Plan, Tenant, Usage, User
+from app.sharding import DEFAULT_SHARD, get_shard
+from app.stats import StatsSnapshot, refresh_stats
+
+
+def load(snapshot):
+    async def run():
+        async with get_shard(DEFAULT_SHARD).AsyncSessionLocal() as db:
+            return await snapshot.get(db)
+    return asyncio.run(run())
+
+
+def test_snapshot_is_stored_and_reloaded(db):
+    snapshot = StatsSnapshot(reload_interval=0)
+    assert load(snapshot) is None
+    assert snapshot.should_request_refresh() and not snapshot.should_request_refresh()
+
+    db.add(Plan(id=1, name="Basic", max_features=2))
+    db.add(Tenant(id=1, name="A", subdomain="a", plan_id=1))
+    db.add(User(email="a@a.test", password_hash="x", tenant_id=1))
+    db.add(Usage(tenant_id=1, feature="F1"))
+    db.commit()
+    refresh_stats()
+    body, generated_at = load(snapshot)
+    stats = orjson.loads(body)
+    assert stats["tenants"] == 1 and stats["users_per_tenant"] == {"1": 1}
+    assert stats["usage"]["1h"] == {"F1": 1}
+
+    db.add(Usage(tenant_id=1, feature="F2"))
+    db.commit()
+    refresh_stats()  # a second refresh overwrites the single row
+    assert orjson.loads(load(snapshot)[0])["usage"]["1h"] == {"F1": 1, "F2": 1}
@@ -0,0 +1,51 @@
+import asyncio, json
+
+from app import security, user_import
+from app.models import Tenant, User
+from app.sharding import DEFAULT_SHARD, get_shard
+
+
+def run_import(rows, chunk_size=4):
+    valid, rejected = user_import.validate_rows(rows)
+
+    async def collect():
+        return "".join([line async for line in user_import.import_users(
+            get_shard(DEFAULT_SHARD).AsyncSessionLocal, 1, valid, rejected, chunk_size)])
+    loop = asyncio.new_event_loop()
+    try:
+        return [json.loads(line) for line in loop.run_until_complete(collect()).splitlines()]
+    finally:
+        loop.close()
+
+
+def users(count):
+    return [{"email": f"u{i}@example.com", "name": f"U{i}", "password": "secret1"} for i in range(count)]
+
+
+def test_import_waits_for_a_busy_hashing_queue(db, monkeypatch):
+    db.add(Tenant(id=1, name="A", subdomain="a"))
+    db.commit()
+    hash_password_async = security.hash_password_async
+    busy = {"left": 5}
+
+    async def sometimes_busy(password):
+        if busy["left"]:
+            busy["left"] -= 1
+            raise security.HashingBusy("Password hashing queue is full")
+        return await hash_password_async(password)
+    monkeypatch.setattr(security, "hash_password_async", sometimes_busy)
+    monkeypatch.setattr(user_import, "USER_IMPORT_BUSY_BACKOFF", 0)
+    lines = run_import(users(6))
+    assert lines[-1] == {"summary": {"created": 6, "duplicate": 0, "invalid": 0}}
+    assert db.query(User).count() == 6
+
+
+def test_import_reports_rows_it_could_not_hash(db, monkeypatch):
+    db.add(Tenant(id=1, name="A", subdomain="a"))
+    db.commit()
+    monkeypatch.setattr(security, "BCRYPT_MAX_PENDING", 0)  # queue stays full
+    monkeypatch.setattr(user_import, "USER_IMPORT_HASH_WAIT", 0)
+    lines = run_import(users(6))
+    assert [line["status"] for line in lines[:-1]] == ["retry"] * 6
+    assert lines[-1] == {"summary": {"created": 0, "duplicate": 0, "invalid": 0, "retry": 6}}
+    assert db.query(User).count() == 0